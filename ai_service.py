@@ -1,7 +1,6 @@
 import os
 import logging
 import asyncio
-import json
 from datetime import datetime
 from typing import Any, Dict, List, Optional
 
@@ -12,6 +11,9 @@ from dotenv import load_dotenv
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+# Reply used when Gemini fails; callers compare against it to avoid caching an outage
+UNAVAILABLE_REPLY = "I'm sorry, I couldn't generate a helpful response at this time."
+
 class AIService:
     """AI service for generating medical assistance responses"""
 
@@ -64,10 +66,10 @@ class AIService:
                     thinking_config=types.ThinkingConfig(thinking_budget=0)
                 ),
             )
-            return response.text or "I'm sorry, I couldn't generate a helpful response at this time."
+            return response.text or UNAVAILABLE_REPLY
         except Exception as e:
             logger.error(f"Gemini AI error: {e}")
-            return "I'm sorry, I couldn't generate a helpful response at this time."
+            return UNAVAILABLE_REPLY
 
     def _build_medical_prompt(
         self,
@@ -4,24 +4,25 @@ A comprehensive FastAPI backend for the SafeDoser medication management app.
 """
 
 import os
+import hashlib
 import logging
 from datetime import datetime, timedelta, date
 from typing import Optional, List, Dict, Any
 import asyncio
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, Request, Form
+from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, Request, Form, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import ORJSONResponse, RedirectResponse
 from pydantic import BaseModel, EmailStr, validator
 import uvicorn
 
 # Import our modules
-from database import Database, get_database
-from auth import AuthService, get_current_user
-from ai_service import AIService
-from email_service import EmailService, EmailDeliveryResult
+from database import Database, get_database, SUPPLEMENT_CHAT_COLUMNS
+from auth import AuthService, get_auth_service, get_current_user, invalidate_user_cache
+from ai_service import AIService, UNAVAILABLE_REPLY
+from email_service import EmailService, EmailDeliveryResult, SMTP_POOL_SIZE
 from token_service import TokenService
 from oauth_service import OAuthService
 from models import (
@@ -40,14 +41,111 @@ logger = logging.getLogger(__name__)
 # Security
 security = HTTPBearer()
 
+# Transient SMTP failures in background sends are retried with exponential backoff (1s, 2s);
+# configuration and recipient errors are not
+EMAIL_SEND_ATTEMPTS = 3
+_NON_RETRYABLE_EMAIL_ERRORS = {
+    "EMAIL_NOT_CONFIGURED", "SMTP_AUTH_FAILED",
+    "RECIPIENTS_REFUSED", "SENDER_REFUSED", "EMAIL_REFUSED", "INVALID_RECIPIENT"
+}
+
+async def deliver_email(send, *args) -> EmailDeliveryResult:
+    """Call an EmailService send method, retrying transient failures"""
+    for attempt in range(EMAIL_SEND_ATTEMPTS):
+        result = await send(*args)
+        if result.success or result.error_code in _NON_RETRYABLE_EMAIL_ERRORS or attempt == EMAIL_SEND_ATTEMPTS - 1:
+            return result
+        delay = 2 ** attempt
+        logger.warning(f"Email send attempt {attempt + 1} failed ({result.error_code}), retrying in {delay}s")
+        await asyncio.sleep(delay)
+    return result
+
+async def send_verification_email_task(email: str, name: str) -> None:
+    """Generate, store and send a verification token (runs on an email worker)"""
+    try:
+        token_service = app.state.token_service
+        email_service = app.state.email_service
+        
+        verification_token = token_service.generate_token(email, "email_verification")
+        token_stored = await token_service.store_verification_token(email, verification_token)
+        if not token_stored:
+            logger.error(f"Failed to store verification token for {email}")
+        
+        email_result = await deliver_email(email_service.send_verification_email, email, name, verification_token)
+        if email_result.success:
+            logger.info(f"Verification email sent successfully to {email}")
+        else:
+            logger.warning(f"Failed to send verification email to {email}: {email_result.message}")
+    
+    except Exception as e:
+        logger.error(f"Background verification email error for {email}: {str(e)}")
+
+async def send_password_reset_email_task(email: str, name: str) -> None:
+    """Generate, store and send a password reset token (runs on an email worker)"""
+    try:
+        token_service = app.state.token_service
+        email_service = app.state.email_service
+        
+        # Storing a new token invalidates previous ones
+        reset_token = token_service.generate_token(email, "password_reset")
+        token_stored = await token_service.store_reset_token(email, reset_token)
+        if not token_stored:
+            logger.error(f"Failed to store reset token for {email}")
+            return
+        
+        email_result = await deliver_email(email_service.send_password_reset_email, email, name, reset_token)
+        if email_result.success:
+            logger.info(f"Password reset email sent successfully to {email} (previous tokens invalidated)")
+        else:
+            logger.error(f"Failed to send password reset email to {email}: {email_result.message}")
+    
+    except Exception as e:
+        logger.error(f"Background password reset email error for {email}: {str(e)}")
+
+# Email jobs (token + send) run on a fixed set of workers fed by a bounded queue: at most
+# SMTP_POOL_SIZE jobs run at once, one per pooled connection, and a full queue pushes back on the
+# request instead of piling up unbounded background work. Queued jobs get a grace period to
+# finish at shutdown.
+EMAIL_QUEUE_SIZE = 1000
+EMAIL_QUEUE_DRAIN_SECONDS = 10
+
+# On a serverless deploy (Vercel sets VERCEL) the function can be frozen as soon as the response
+# is sent, so nothing queued would reliably run: email jobs are awaited inline there instead.
+SEND_EMAIL_INLINE = bool(os.getenv("VERCEL"))
+
+async def enqueue_email_job(job, *args) -> bool:
+    """Queue an email job for the workers (or run it inline on serverless); returns False when the queue is full"""
+    if SEND_EMAIL_INLINE:
+        try:
+            await job(*args)
+        except Exception as e:
+            logger.error(f"Email job {job.__name__} failed: {str(e)}")
+        return True
+    try:
+        app.state.email_queue.put_nowait((job, args))
+        return True
+    except asyncio.QueueFull:
+        logger.warning(f"Email queue full, dropping {job.__name__}")
+        return False
+
+async def email_worker(queue: asyncio.Queue) -> None:
+    """Run queued email jobs one at a time (jobs log their own failures)"""
+    while True:
+        job, args = await queue.get()
+        try:
+            await job(*args)
+        except Exception as e:
+            logger.error(f"Email job {job.__name__} failed: {str(e)}")
+        finally:
+            queue.task_done()
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Application lifespan manager"""
     logger.info("Starting SafeDoser Backend API...")
     
-    # Initialize database
-    db = Database()
-    await db.initialize()
+    # Initialize the shared database instance
+    db = await get_database()
     
     # Initialize services
     ai_service = AIService()
@@ -62,12 +160,23 @@ async def lifespan(app: FastAPI):
     app.state.token_service = token_service
     app.state.oauth_service = oauth_service
     
+    # Start the email workers (not needed when jobs run inline)
+    email_queue: asyncio.Queue = asyncio.Queue(maxsize=EMAIL_QUEUE_SIZE)
+    email_workers = [] if SEND_EMAIL_INLINE else [
+        asyncio.create_task(email_worker(email_queue)) for _ in range(SMTP_POOL_SIZE)
+    ]
+    app.state.email_queue = email_queue
+    
+    # Sweep expired verification/reset tokens left since the last run (pg_cron does the
+    # regular sweep, see migrations/011); it runs in the background so startup doesn't wait
+    token_cleanup = asyncio.create_task(token_service.cleanup_expired_tokens())
+    
     # Log email service status
     email_config = email_service.get_configuration_status()
     if email_config["configured"]:
         logger.info("Email service configured successfully")
         # Test SMTP connection
-        test_result = email_service.test_smtp_connection()
+        test_result = await email_service.test_smtp_connection()
         if test_result.success:
             logger.info("SMTP connection test successful")
         else:
@@ -89,6 +198,15 @@ async def lifespan(app: FastAPI):
     
     # Cleanup
     logger.info("Shutting down SafeDoser Backend API...")
+    try:
+        await asyncio.wait_for(email_queue.join(), timeout=EMAIL_QUEUE_DRAIN_SECONDS)
+    except asyncio.TimeoutError:
+        logger.warning(f"{email_queue.qsize()} queued emails not sent before shutdown")
+    for task in (token_cleanup, *email_workers):
+        task.cancel()
+    await asyncio.gather(token_cleanup, *email_workers, return_exceptions=True)
+    await email_service.close()
+    await oauth_service.close()
     await db.close()
 
 # Create FastAPI app
@@ -98,6 +216,7 @@ app = FastAPI(
     version="1.0.0",
     docs_url="/docs",
     redoc_url="/redoc",
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
@@ -135,7 +254,7 @@ async def email_status():
     
     # Test connection if configured
     if config["configured"]:
-        test_result = email_service.test_smtp_connection()
+        test_result = await email_service.test_smtp_connection()
         config["connection_test"] = {
             "success": test_result.success,
             "message": test_result.message,
@@ -233,12 +352,10 @@ class PasswordResetConfirm(BaseModel):
 @app.post("/auth/signup", response_model=UserResponse)
 async def signup(
     user_data: UserCreate,
-    db: Database = Depends(get_database)
+    auth_service: AuthService = Depends(get_auth_service)
 ):
     """Create a new user account with email verification"""
-    auth_service = AuthService(db)
     email_service = app.state.email_service
-    token_service = app.state.token_service
     
     try:
         logger.info(f"Signup attempt for email: {user_data.email}")
@@ -256,41 +373,29 @@ async def signup(
         user = await auth_service.create_user(user_data)
         logger.info(f"User created successfully: {user['id']}")
         
-        # Generate verification token
-        verification_token = token_service.generate_token(user_data.email, "email_verification")
-        
-        # Store verification token
-        token_stored = await token_service.store_verification_token(user_data.email, verification_token)
-        
-        if not token_stored:
-            logger.error(f"Failed to store verification token for {user_data.email}")
-        
-        # Send verification email
-        email_result = await email_service.send_verification_email(
-            user_data.email, 
-            user_data.name, 
-            verification_token
-        )
+        # Token generation, storage and SMTP delivery happen on the email workers
+        if not email_service.is_configured:
+            email_sent = False
+            email_message = "Email service not configured. Please check SMTP settings."
+        elif await enqueue_email_job(send_verification_email_task, user_data.email, user_data.name):
+            email_sent = True
+            email_message = "Verification email is on its way"
+        else:
+            email_sent = False
+            email_message = "Email service is busy. Please request a new verification email shortly."
         
         # Generate tokens (user can use app but some features may be limited)
-        access_token = auth_service.create_access_token(user["id"])
-        refresh_token = auth_service.create_refresh_token(user["id"])
+        access_token, refresh_token = auth_service.create_token_pair(user["id"])
 
         response_data = {
             "user": user,
             "access_token": access_token,
             "refresh_token": refresh_token,
             "token_type": "bearer",
-            "email_sent": email_result.success,
-            "email_message": email_result.message
+            "email_sent": email_sent,
+            "email_message": email_message
         }
 
-        # Log email delivery status
-        if email_result.success:
-            logger.info(f"Verification email sent successfully to {user_data.email}")
-        else:
-            logger.warning(f"Failed to send verification email to {user_data.email}: {email_result.message}")
-
         return UserResponse(**response_data)
         
     except HTTPException as http_exc:
@@ -306,14 +411,13 @@ async def signup(
 @app.post("/auth/verify-email")
 async def verify_email(
     verification_data: EmailVerificationRequest,
-    db: Database = Depends(get_database)
+    auth_service: AuthService = Depends(get_auth_service)
 ):
     """Verify user email address"""
     try:
         logger.info(f"Email verification attempt for: {verification_data.email}")
         
         token_service = app.state.token_service
-        auth_service = AuthService(db)
         
         # Verify the token
         is_valid = await token_service.verify_token(
@@ -364,7 +468,7 @@ async def verify_email(
 @app.post("/auth/resend-verification")
 async def resend_verification_email(
     email_data: dict,
-    db: Database = Depends(get_database)
+    auth_service: AuthService = Depends(get_auth_service)
 ):
     """Resend verification email"""
     try:
@@ -377,9 +481,7 @@ async def resend_verification_email(
         
         logger.info(f"Resend verification request for: {email}")
         
-        auth_service = AuthService(db)
         email_service = app.state.email_service
-        token_service = app.state.token_service
         
         # Check if user exists
         user = await auth_service.get_user_by_email(email)
@@ -398,38 +500,18 @@ async def resend_verification_email(
                 detail="Email is already verified"
             )
         
-        # Generate new verification token (this will invalidate previous ones)
-        verification_token = token_service.generate_token(email, "email_verification")
-        
-        # Store verification token (this will invalidate previous ones)
-        token_stored = await token_service.store_verification_token(email, verification_token)
-        
-        if not token_stored:
-            logger.error(f"Failed to store verification token for {email}")
+        # Token generation (invalidating previous ones) and delivery happen on the email workers
+        if not await enqueue_email_job(send_verification_email_task, email, user["name"]):
             raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to generate verification token"
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Email service is busy, please try again shortly"
             )
         
-        # Send verification email
-        email_result = await email_service.send_verification_email(
-            email, 
-            user["name"], 
-            verification_token
-        )
-        
-        if email_result.success:
-            logger.info(f"Verification email resent successfully to {email} (previous tokens invalidated)")
-            return {
-                "message": "Verification email sent successfully",
-                "email_sent": True
-            }
-        else:
-            logger.error(f"Failed to resend verification email to {email}: {email_result.message}")
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Failed to send verification email: {email_result.message}"
-            )
+        logger.info(f"Verification email queued for {email}")
+        return {
+            "message": "Verification email is on its way",
+            "email_sent": email_service.is_configured
+        }
         
     except HTTPException:
         raise
@@ -443,14 +525,12 @@ async def resend_verification_email(
 @app.post("/auth/login", response_model=UserResponse)
 async def login(
     credentials: UserLogin,
-    db: Database = Depends(get_database)
+    auth_service: AuthService = Depends(get_auth_service)
 ):
     """Authenticate user and return tokens"""
     try:
         logger.info(f"Login attempt for email: {credentials.email}")
         
-        auth_service = AuthService(db)
-        
         # Authenticate user (this will check email verification)
         user = await auth_service.authenticate_user(
             credentials.email, 
@@ -465,8 +545,7 @@ async def login(
             )
         
         # Generate tokens
-        access_token = auth_service.create_access_token(user["id"])
-        refresh_token = auth_service.create_refresh_token(user["id"])
+        access_token, refresh_token = auth_service.create_token_pair(user["id"])
         
         logger.info(f"Login successful for user: {user['id']}")
         
@@ -489,15 +568,13 @@ async def login(
 @app.post("/auth/forgot-password")
 async def forgot_password(
     request_data: PasswordResetRequest,
-    db: Database = Depends(get_database)
+    auth_service: AuthService = Depends(get_auth_service)
 ):
     """Send password reset email"""
     try:
         logger.info(f"Password reset request for: {request_data.email}")
         
-        auth_service = AuthService(db)
         email_service = app.state.email_service
-        token_service = app.state.token_service
         
         # Check if user exists
         user = await auth_service.get_user_by_email(request_data.email)
@@ -510,41 +587,14 @@ async def forgot_password(
                 "reason": "User not found"
             }
         
-        # Generate reset token (this will invalidate previous ones)
-        reset_token = token_service.generate_token(request_data.email, "password_reset")
-        
-        # Store reset token (this will invalidate previous ones)
-        token_stored = await token_service.store_reset_token(request_data.email, reset_token)
-        
-        if not token_stored:
-            logger.error(f"Failed to store reset token for {request_data.email}")
-            return {
-                "message": "If the email exists in our system, a reset link has been sent",
-                "email_sent": False,
-                "reason": "Token storage failed"
-            }
-        
-        # Send reset email
-        email_result = await email_service.send_password_reset_email(
-            request_data.email,
-            user["name"],
-            reset_token
-        )
+        # Token generation (invalidating previous ones) and delivery happen on the email workers
+        queued = await enqueue_email_job(send_password_reset_email_task, request_data.email, user["name"])
         
-        if email_result.success:
-            logger.info(f"Password reset email sent successfully to {request_data.email} (previous tokens invalidated)")
-            return {
-                "message": "If the email exists in our system, a reset link has been sent",
-                "email_sent": True
-            }
-        else:
-            logger.error(f"Failed to send password reset email to {request_data.email}: {email_result.message}")
-            return {
-                "message": "If the email exists in our system, a reset link has been sent",
-                "email_sent": False,
-                "reason": email_result.message,
-                "error_code": email_result.error_code
-            }
+        logger.info(f"Password reset email {'queued' if queued else 'dropped (queue full)'} for {request_data.email}")
+        return {
+            "message": "If the email exists in our system, a reset link has been sent",
+            "email_sent": email_service.is_configured and queued
+        }
         
     except Exception as e:
         logger.error(f"Password reset error: {str(e)}")
@@ -558,13 +608,12 @@ async def forgot_password(
 @app.post("/auth/reset-password")
 async def reset_password(
     reset_data: PasswordResetConfirm,
-    db: Database = Depends(get_database)
+    auth_service: AuthService = Depends(get_auth_service)
 ):
     """Reset user password with token"""
     try:
         logger.info(f"Password reset confirmation for: {reset_data.email}")
         
-        auth_service = AuthService(db)
         token_service = app.state.token_service
         
         # Verify the reset token
@@ -608,14 +657,13 @@ async def reset_password(
 @app.post("/auth/refresh")
 async def refresh_token(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Database = Depends(get_database)
+    auth_service: AuthService = Depends(get_auth_service)
 ):
     """Refresh access token"""
     try:
-        auth_service = AuthService(db)
         
         # Verify refresh token and get user
-        user_id = auth_service.verify_refresh_token(credentials.credentials)
+        user_id = auth_service.verify_token(credentials.credentials, "refresh")
         user = await auth_service.get_user_by_id(user_id)
         
         if not user:
@@ -651,11 +699,10 @@ async def get_profile(
 async def update_profile(
     profile_data: UserUpdate,
     current_user: dict = Depends(get_current_user),
-    db: Database = Depends(get_database)
+    auth_service: AuthService = Depends(get_auth_service)
 ):
     """Update user profile"""
     try:
-        auth_service = AuthService(db)
         
         # Update user profile
         updated_user = await auth_service.update_user(
@@ -683,7 +730,10 @@ async def get_supplements(
         logger.debug(f"Getting supplements for user: {current_user['id']}")
         supplements = await db.get_user_supplements(current_user["id"])
         logger.debug(f"Found {len(supplements)} supplements")
-        return supplements
+        
+        # Rows already have exactly the SupplementResponse columns; serialize them straight
+        # through orjson instead of re-validating each one (response_model kept for docs)
+        return ORJSONResponse(supplements)
         
     except Exception as e:
         logger.error(f"Get supplements error: {str(e)}")
@@ -731,21 +781,19 @@ async def update_supplement(
         logger.info(f"Updating supplement {supplement_id} for user: {current_user['id']}")
         logger.debug(f"Update data: {supplement_data.dict(exclude_unset=True)}")
         
-        # Verify supplement belongs to user
-        supplement = await db.get_supplement_by_id(supplement_id)
-        if not supplement or supplement["user_id"] != current_user["id"]:
+        # Update supplement; the user_id filter enforces ownership in the same query
+        updated_supplement = await db.update_supplement(
+            supplement_id, 
+            supplement_data.dict(exclude_unset=True),
+            user_id=current_user["id"]
+        )
+        if not updated_supplement:
             logger.warning(f"Supplement not found or access denied: {supplement_id}")
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Supplement not found"
             )
         
-        # Update supplement
-        updated_supplement = await db.update_supplement(
-            supplement_id, 
-            supplement_data.dict(exclude_unset=True)
-        )
-        
         logger.info(f"Supplement updated successfully: {supplement_id}")
         return updated_supplement
         
@@ -768,18 +816,15 @@ async def delete_supplement(
     try:
         logger.info(f"Deleting supplement {supplement_id} for user: {current_user['id']}")
         
-        # Verify supplement belongs to user
-        supplement = await db.get_supplement_by_id(supplement_id)
-        if not supplement or supplement["user_id"] != current_user["id"]:
+        # Delete supplement; the user_id filter enforces ownership in the same query
+        deleted = await db.delete_supplement(supplement_id, user_id=current_user["id"])
+        if not deleted:
             logger.warning(f"Supplement not found or access denied: {supplement_id}")
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Supplement not found"
             )
         
-        # Delete supplement
-        await db.delete_supplement(supplement_id)
-        
         logger.info(f"Supplement deleted successfully: {supplement_id}")
         return {"message": "Supplement deleted successfully"}
         
@@ -806,7 +851,9 @@ async def get_today_supplement_logs(
         logs = await db.get_supplement_logs_by_date(current_user["id"], today)
         
         logger.debug(f"Found {len(logs)} supplement logs for today")
-        return logs
+        
+        # Plain rows: skip jsonable_encoder's walk over every value
+        return ORJSONResponse(logs)
         
     except Exception as e:
         logger.error(f"Get today's supplement logs error: {str(e)}")
@@ -825,8 +872,21 @@ async def mark_supplement_completed(
     try:
         logger.info(f"Marking supplement {log_data.supplement_id} as {log_data.status} at {log_data.scheduled_time} for user: {current_user['id']}")
         
+        # Look up the supplement (ownership check) and any log already recorded for today at
+        # the same time concurrently
+        now = datetime.utcnow()
+        today = date.today()
+        supplement, existing_log = await asyncio.gather(
+            db.get_supplement_by_id(log_data.supplement_id),
+            db.get_supplement_log_by_supplement_and_time(
+                current_user["id"], 
+                log_data.supplement_id, 
+                log_data.scheduled_time, 
+                today
+            )
+        )
+        
         # Verify supplement belongs to user
-        supplement = await db.get_supplement_by_id(log_data.supplement_id)
         if not supplement or supplement["user_id"] != current_user["id"]:
             logger.warning(f"Supplement not found or access denied: {log_data.supplement_id}")
             raise HTTPException(
@@ -834,15 +894,6 @@ async def mark_supplement_completed(
                 detail="Supplement not found"
             )
         
-        # Check if log already exists for today
-        today = date.today()
-        existing_log = await db.get_supplement_log_by_supplement_and_time(
-            current_user["id"], 
-            log_data.supplement_id, 
-            log_data.scheduled_time, 
-            today
-        )
-        
         if existing_log:
             # Update existing log
             update_data = {
@@ -851,7 +902,7 @@ async def mark_supplement_completed(
             }
             
             if log_data.status == "taken":
-                update_data["taken_at"] = datetime.utcnow()
+                update_data["taken_at"] = now
             
             updated_log = await db.update_supplement_log(existing_log["id"], update_data)
             logger.info(f"Updated existing supplement log: {existing_log['id']}")
@@ -867,7 +918,7 @@ async def mark_supplement_completed(
             }
             
             if log_data.status == "taken":
-                log_create_data["taken_at"] = datetime.utcnow()
+                log_create_data["taken_at"] = now
             
             new_log = await db.create_supplement_log(log_create_data)
             logger.info(f"Created new supplement log: {new_log['id']}")
@@ -893,26 +944,33 @@ async def update_supplement_log(
     try:
         logger.info(f"Updating supplement log {log_id} for user: {current_user['id']}")
         
-        # Verify log belongs to user
-        log = await db.get_supplement_log_by_id(log_id)
-        if not log or log["user_id"] != current_user["id"]:
+        # Prepare update data
+        update_data = log_data.dict(exclude_unset=True)
+        updated_log = None
+        
+        # Ownership is enforced by the user_id filter on the UPDATE itself, so there is no
+        # separate fetch. taken_at is only stamped on the transition into "taken": that
+        # update skips logs already taken, which then fall through to the plain update.
+        if log_data.status == "taken":
+            updated_log = await db.update_supplement_log(
+                log_id,
+                {**update_data, "taken_at": datetime.utcnow()},
+                user_id=current_user["id"],
+                exclude_status="taken"
+            )
+        elif log_data.status:
+            update_data["taken_at"] = None
+        
+        if updated_log is None:
+            updated_log = await db.update_supplement_log(log_id, update_data, user_id=current_user["id"])
+        
+        if not updated_log:
             logger.warning(f"Supplement log not found or access denied: {log_id}")
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Supplement log not found"
             )
         
-        # Prepare update data
-        update_data = log_data.dict(exclude_unset=True)
-        
-        # Set taken_at timestamp if status is being changed to taken
-        if log_data.status == "taken" and log.get("status") != "taken":
-            update_data["taken_at"] = datetime.utcnow()
-        elif log_data.status and log_data.status != "taken":
-            update_data["taken_at"] = None
-        
-        updated_log = await db.update_supplement_log(log_id, update_data)
-        
         logger.info(f"Supplement log updated successfully: {log_id}")
         return updated_log
         
@@ -938,11 +996,14 @@ async def send_chat_message(
         
         ai_service = app.state.ai_service
         
-        # Get user's supplements for context
-        supplements = await db.get_user_supplements(current_user["id"])
-        
-        # Get recent chat history
-        chat_history = await db.get_chat_history(current_user["id"], limit=10)
+        # Get user's supplements for context (only the fields the assistant uses) and recent
+        # chat history; the two reads are independent, so run them concurrently
+        supplements, chat_history = await asyncio.gather(
+            db.get_user_supplements(current_user["id"], columns=SUPPLEMENT_CHAT_COLUMNS),
+            db.get_chat_history(
+                current_user["id"], limit=10, cleared_at=current_user.get("chat_cleared_at")
+            )
+        )
         
         # Prepare context for AI
         context = {
@@ -952,12 +1013,33 @@ async def send_chat_message(
             "current_time": datetime.utcnow().isoformat()
         }
         
-        # Generate AI response
-        ai_response = await ai_service.generate_response(
-            message_data.message,
-            context,
-            chat_history
+        # Exact-match cache: same user, same question (case/whitespace-insensitive), the same
+        # profile/supplement fields and the same recent conversation (the last 6 messages the
+        # prompt includes), so a follow-up like "why?" is never answered from another exchange
+        normalized_message = " ".join(message_data.message.lower().split())
+        supplement_key = "|".join(
+            f"{s.get('name', '')},{s.get('dosage_form', '')},{s.get('frequency', '')}" for s in supplements
         )
+        history_key = "\x1f".join(
+            f"{m.get('sender', '')}:{m.get('message', '')}" for m in (chat_history or [])[-6:]
+        )
+        msg_hash = hashlib.sha256(
+            f"{normalized_message}\n{current_user['name']}\n{current_user['age']}\n{supplement_key}\n{history_key}".encode("utf-8")
+        ).hexdigest()
+        
+        ai_response = db.get_cached_response(current_user["id"], msg_hash)
+        if ai_response is None:
+            # Generate AI response
+            ai_response = await ai_service.generate_response(
+                message_data.message,
+                context,
+                chat_history
+            )
+            # Only real model answers are cached, never fallbacks or outage replies
+            if ai_service.client is not None and ai_response != UNAVAILABLE_REPLY:
+                db.set_cached_response(current_user["id"], msg_hash, ai_response)
+        else:
+            logger.debug(f"Chat response cache hit for user {current_user['id']}")
         
         # Save user message
         await db.save_chat_message(
@@ -994,15 +1076,25 @@ async def send_chat_message(
 
 @app.get("/chat/history", response_model=ChatHistoryResponse)
 async def get_chat_history(
-    limit: int = 50,
+    limit: int = Query(50, ge=1, le=200),
+    before: Optional[datetime] = None,
     current_user: dict = Depends(get_current_user),
     db: Database = Depends(get_database)
 ):
-    """Get chat history"""
+    """Get chat history, paginated backwards from the `before` cursor"""
     try:
-        logger.debug(f"Getting chat history for user {current_user['id']}, limit: {limit}")
-        messages = await db.get_chat_history(current_user["id"], limit)
-        return ChatHistoryResponse(messages=messages)
+        logger.debug(f"Getting chat history for user {current_user['id']}, limit: {limit}, before: {before}")
+        messages = await db.get_chat_history(
+            current_user["id"], limit, before=before.isoformat() if before else None,
+            cleared_at=current_user.get("chat_cleared_at")
+        )
+        
+        # A full page means there may be older messages; the oldest timestamp is the next cursor
+        next_cursor = messages[0].get("timestamp") if messages and len(messages) == limit else None
+        
+        # Rows are already plain dicts; serialize them straight through orjson rather than
+        # re-validating every message into ChatHistoryResponse (kept as response_model for docs)
+        return ORJSONResponse({"messages": messages, "next_cursor": next_cursor})
         
     except Exception as e:
         logger.error(f"Get chat history error: {str(e)}")
@@ -1019,9 +1111,17 @@ async def clear_chat_history(
     """Clear chat history"""
     try:
         logger.info(f"Clearing chat history for user: {current_user['id']}")
-        await db.clear_chat_history(current_user["id"])
+        if not await db.clear_chat_history(current_user["id"]):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="User not found"
+            )
+        # chat_cleared_at lives on the user row, so drop cached copies of it
+        invalidate_user_cache(current_user["id"])
         return {"message": "Chat history cleared successfully"}
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Clear chat history error: {str(e)}")
         raise HTTPException(
@@ -1033,7 +1133,8 @@ async def clear_chat_history(
 @app.post("/upload/image")
 async def upload_image(
     file: UploadFile = File(...),
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    db: Database = Depends(get_database)
 ):
     """Upload an image file"""
     try:
@@ -1045,7 +1146,7 @@ async def upload_image(
             )
         
         # Handle image upload
-        image_url = await handle_image_upload(file, current_user["id"])
+        image_url = await handle_image_upload(file, current_user["id"], db.supabase)
         
         return {"image_url": image_url}
         
@@ -1062,7 +1163,7 @@ async def upload_image(
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request, exc):
     """Handle HTTP exceptions"""
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=exc.status_code,
         content={"error": exc.detail}
     )
@@ -1071,7 +1172,7 @@ async def http_exception_handler(request, exc):
 async def general_exception_handler(request, exc):
     """Handle general exceptions"""
     logger.error(f"Unhandled exception: {str(exc)}")
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content={"error": "Internal server error"}
     )
@@ -1079,9 +1180,16 @@ async def general_exception_handler(request, exc):
 # Run the application
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))
+    reload = os.getenv("ENVIRONMENT") == "development"
     uvicorn.run(
         "app:app",
         host="0.0.0.0",
         port=port,
-        reload=os.getenv("ENVIRONMENT") == "development"
+        # "auto" picks uvloop/httptools when installed (they are skipped on Windows)
+        loop="auto",
+        http="auto",
+        reload=reload,
+        workers=None if reload else int(os.getenv("WEB_CONCURRENCY", 1)),
+        proxy_headers=True,
+        backlog=2048
     )
\ No newline at end of file
@@ -4,33 +4,172 @@ Handles user authentication, JWT tokens, and password hashing
 """
 
 import os
+import re
+import asyncio
+import hashlib
+import hmac
 import logging
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+import threading
+import time
+from typing import Optional, Dict, Any, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import secrets
 
+from cachetools import TTLCache
+
 from fastapi import HTTPException, Depends, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from passlib.context import CryptContext
-from jose import JWTError, jwt
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+import bcrypt
+import orjson
 import base64
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from database import Database, get_database
+from database import Database, get_database, _execute
 
 logger = logging.getLogger(__name__)
 
 # Security configuration
 security = HTTPBearer()
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+optional_security = HTTPBearer(auto_error=False)
+# Argon2id; bcrypt hashes created before the switch are still verified and get upgraded on login
+password_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=2)
+
+# Hashing is CPU-bound (tens of ms); run it on a dedicated pool sized to the CPU count so it
+# neither blocks the event loop nor starves the default executor during login bursts
+_hash_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="password-hash")
+
+# Demo account that logs in without a password check; set DEMO_LOGIN_ENABLED=false to turn it off
+DEMO_EMAIL = "demo@safedoser.com"
+DEMO_LOGIN_ENABLED = os.getenv("DEMO_LOGIN_ENABLED", "true").lower() == "true"
+
+def _is_demo_email(email: Optional[str]) -> bool:
+    """Constant-time check for the demo account email"""
+    return hmac.compare_digest((email or "").encode("utf-8"), DEMO_EMAIL.encode("utf-8"))
+
+# Verified against when the user doesn't exist, so both login paths cost the same. It is the
+# hash of a discarded random password made with the same Argon2 parameters as password_hasher.
+_DUMMY_HASH = "$argon2id$v=19$m=65536,t=2,p=2$3LwSxjsZEHNgsl5I8FRxOw$vSfqQiHZPLgcd6WIYTrzvPDdUzRzv8Uqv8j+leLVty4"
+
+# Test runs and seed imports hash the same few passwords over and over; SAFEDOSER_HASH_CACHE=1
+# memoizes them. Never enable this in production: equal passwords would share a salt.
+if os.getenv("SAFEDOSER_HASH_CACHE") == "1":
+    _hash_password = lru_cache(maxsize=128)(password_hasher.hash)
+else:
+    _hash_password = password_hasher.hash
+
+def _verify_password(plain_password: str, hashed_password: str) -> bool:
+    """Verify a password against an Argon2 or legacy bcrypt hash"""
+    if hashed_password.startswith("$2"):
+        # Legacy bcrypt hash
+        try:
+            return bcrypt.checkpw(plain_password.encode("utf-8"), hashed_password.encode("utf-8"))
+        except ValueError:
+            return False
+    try:
+        return password_hasher.verify(hashed_password, plain_password)
+    except (VerificationError, InvalidHashError):
+        return False
 
 # JWT configuration
-SECRET_KEY = os.getenv("JWT_SECRET_KEY", secrets.token_urlsafe(32))
+SECRET_KEY = os.getenv("JWT_SECRET_KEY")
+if not SECRET_KEY:
+    # A random per-process key logs everyone out on every restart and breaks multi-worker
+    # deployments (each worker signs with its own key), so only allow it outside production
+    if os.getenv("ENVIRONMENT") == "production":
+        raise RuntimeError("JWT_SECRET_KEY must be set in production")
+    logger.warning("JWT_SECRET_KEY not set; using a random key, tokens won't survive a restart")
+    SECRET_KEY = secrets.token_urlsafe(32)
 ALGORITHM = "HS256"
+_JWT_REQUIRED_CLAIMS = ("exp", "sub", "type")
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 REFRESH_TOKEN_EXPIRE_DAYS = 7
+ACCESS_TOKEN_EXPIRE_SECONDS = ACCESS_TOKEN_EXPIRE_MINUTES * 60
+REFRESH_TOKEN_EXPIRE_SECONDS = REFRESH_TOKEN_EXPIRE_DAYS * 24 * 60 * 60
+
+# Short-lived cache of decoded tokens: (token, token_type) -> (user_id, exp), or _INVALID_TOKEN.
+# Keyed on the full token string so any change to it is a miss; entries never outlive the
+# token's own exp. Replayed bad tokens are rejected without decoding again.
+TOKEN_CACHE_TTL_SECONDS = 5
+_INVALID_TOKEN = object()
+_token_cache: TTLCache = TTLCache(maxsize=10000, ttl=TOKEN_CACHE_TTL_SECONDS)
+_token_cache_lock = threading.Lock()
+
+# Access token -> (user dict, exp) for get_current_user, so a burst of requests with the same
+# token skips both the decode and the users lookup. Entries are dropped by
+# invalidate_user_cache() whenever the user row changes.
+USER_CACHE_TTL_SECONDS = 10
+_user_cache: TTLCache = TTLCache(maxsize=5000, ttl=USER_CACHE_TTL_SECONDS)
+
+# HS256 with a fixed key: the HMAC inner/outer pad state is computed once here and each
+# sign/verify clones it instead of re-keying. The header never changes either.
+_HMAC_TEMPLATE = hmac.new(SECRET_KEY.encode("utf-8"), digestmod=hashlib.sha256)
+
+def _b64url_encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+# Unpadded base64url only: urlsafe_b64decode silently drops stray characters and accepts
+# padding, so several spellings of a segment would otherwise decode to the same bytes.
+_B64URL_SEGMENT_RE = re.compile(rb"[A-Za-z0-9_-]*")
+
+def _b64url_decode(data: bytes) -> bytes:
+    if not _B64URL_SEGMENT_RE.fullmatch(data):
+        raise ValueError("Invalid base64url segment")
+    return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
+_JWT_HEADER_SEGMENT = _b64url_encode(orjson.dumps({"alg": ALGORITHM, "typ": "JWT"}))
+
+def _sign(signing_input: bytes) -> bytes:
+    mac = _HMAC_TEMPLATE.copy()
+    mac.update(signing_input)
+    return mac.digest()
+
+def _encode_jwt(claims: Dict[str, Any]) -> str:
+    """Sign a claims dict as an HS256 JWT, serializing the payload with orjson"""
+    signing_input = _JWT_HEADER_SEGMENT + b"." + _b64url_encode(orjson.dumps(claims))
+    return (signing_input + b"." + _b64url_encode(_sign(signing_input))).decode("ascii")
+
+def _decode_jwt(token: str, token_type: str) -> Dict[str, Any]:
+    """Verify an HS256 JWT of the given type and parse its payload with orjson.
+
+    Raises ValueError for anything malformed, forged, of the wrong type or missing required
+    claims; expiry is checked by the caller.
+    """
+    raw = token.encode("ascii")
+    header_segment, payload_segment, signature_segment = raw.split(b".")
+    
+    header = orjson.loads(_b64url_decode(header_segment))
+    if not isinstance(header, dict) or header.get("alg") != ALGORITHM:
+        raise ValueError("Unsupported token algorithm")
+    
+    # The payload is parsed once, before the HMAC, so a token of the wrong type (e.g. a refresh
+    # token sent to an API endpoint) is rejected without signature work. Nothing from an
+    # unverified payload is ever returned: a wrong type only ever leads to rejection.
+    payload = orjson.loads(_b64url_decode(payload_segment))
+    if not isinstance(payload, dict) or payload.get("type") != token_type:
+        raise ValueError("Wrong token type")
+    
+    signing_input = raw[:len(header_segment) + 1 + len(payload_segment)]
+    # Compare the canonical encoding of the expected signature, so a segment that only
+    # decodes to the right bytes (non-zero trailing bits) is still rejected.
+    if not hmac.compare_digest(_b64url_encode(_sign(signing_input)), signature_segment):
+        raise ValueError("Invalid token signature")
+    
+    if any(claim not in payload for claim in _JWT_REQUIRED_CLAIMS):
+        raise ValueError("Missing required claims")
+    if not isinstance(payload["sub"], str) or not isinstance(payload["exp"], (int, float)):
+        raise ValueError("Invalid sub or exp claim")
+    return payload
+
+def invalidate_user_cache(user_id: str) -> None:
+    """Drop every cached get_current_user result for a user"""
+    for token, (user, _) in list(_user_cache.items()):
+        if user.get("id") == user_id:
+            _user_cache.pop(token, None)
 
 class AuthService:
     """Authentication service for user management"""
@@ -38,80 +177,108 @@ class AuthService:
     def __init__(self, db: Database):
         self.db = db
     
-    def hash_password(self, password: str) -> str:
-        """Hash a password"""
-        return pwd_context.hash(password)
+    async def hash_password(self, password: str) -> str:
+        """Hash a password off the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_hash_executor, _hash_password, password)
     
-    def verify_password(self, plain_password: str, hashed_password: str) -> bool:
-        """Verify a password against its hash"""
-        return pwd_context.verify(plain_password, hashed_password)
+    async def verify_password(self, plain_password: str, hashed_password: str) -> bool:
+        """Verify a password against its hash off the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_hash_executor, _verify_password, plain_password, hashed_password)
+    
+    def password_needs_rehash(self, hashed_password: str) -> bool:
+        """Check if a hash is legacy bcrypt or uses outdated Argon2 parameters"""
+        if hashed_password.startswith("$2"):
+            return True
+        try:
+            return password_hasher.check_needs_rehash(hashed_password)
+        except InvalidHashError:
+            return False
     
     def create_access_token(self, user_id: str) -> str:
         """Create an access token"""
-        expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
         to_encode = {
             "sub": user_id,
-            "exp": expire,
+            "exp": int(time.time()) + ACCESS_TOKEN_EXPIRE_SECONDS,
             "type": "access"
         }
-        return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+        return _encode_jwt(to_encode)
     
     def create_refresh_token(self, user_id: str) -> str:
         """Create a refresh token"""
-        expire = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
         to_encode = {
             "sub": user_id,
-            "exp": expire,
+            "exp": int(time.time()) + REFRESH_TOKEN_EXPIRE_SECONDS,
             "type": "refresh"
         }
-        return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+        return _encode_jwt(to_encode)
+    
+    def create_token_pair(self, user_id: str) -> Tuple[str, str]:
+        """Create an (access, refresh) token pair for a login, reading the clock once"""
+        now = int(time.time())
+        access_token = _encode_jwt({"sub": user_id, "exp": now + ACCESS_TOKEN_EXPIRE_SECONDS, "type": "access"})
+        refresh_token = _encode_jwt({"sub": user_id, "exp": now + REFRESH_TOKEN_EXPIRE_SECONDS, "type": "refresh"})
+        return access_token, refresh_token
     
     def verify_token(self, token: str, token_type: str = "access") -> str:
         """Verify a JWT token and return user ID"""
-        try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            user_id: Optional[str] = payload.get("sub")
-            token_type_claim: Optional[str] = payload.get("type")
-            
-            if user_id is None or token_type_claim != token_type:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="Invalid token"
-                )
-            
-            return user_id
-            
-        except JWTError:
+        claims = self._decode_token_claims(token, token_type)
+        if claims is None:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid token"
             )
+        return claims[0]
     
-    def verify_access_token(self, token: str) -> str:
-        """Verify an access token"""
-        return self.verify_token(token, "access")
-    
-    def verify_refresh_token(self, token: str) -> str:
-        """Verify a refresh token"""
-        return self.verify_token(token, "refresh")
+    def _decode_token_claims(self, token: str, token_type: str) -> Optional[tuple]:
+        """Decode a JWT token into its (user ID, exp) claims, or None if it is invalid or expired"""
+        key = (token, token_type)
+        with _token_cache_lock:
+            cached = _token_cache.get(key)
+        
+        if cached is None:
+            try:
+                payload = _decode_jwt(token, token_type)
+                cached = (payload["sub"], payload["exp"])
+            except ValueError:
+                cached = _INVALID_TOKEN
+            
+            with _token_cache_lock:
+                _token_cache[key] = cached
+        
+        if cached is _INVALID_TOKEN or cached[1] <= time.time():
+            return None
+        
+        return cached
     
     async def create_user(self, user_data) -> Dict[str, Any]:
         try:
-            # Hash password
-            hashed_password = self.hash_password(user_data.password)
-
             # Ensure supabase client is initialized
             if not hasattr(self.db, "supabase") or self.db.supabase is None:
                 raise Exception("Supabase client is not initialized in the database instance")
 
-            # Sign up in Supabase auth
-            auth_response = self.db.supabase.auth.sign_up({
-                "email": user_data.email,
-                "password": user_data.password  # plain password for auth
-            })
+            # Hash the password while the Supabase auth signup is in flight. Sign-up goes through a
+            # throwaway auth client so the new user's session never lands on the shared client.
+            
+            # return_exceptions, so a hashing failure still lets us see (and roll back) a signup
+            # that went through.
+            hashed_password, auth_response = await asyncio.gather(
+                self.hash_password(user_data.password),
+                asyncio.to_thread(self.db.new_auth_client().sign_up, {
+                    "email": user_data.email,
+                    "password": user_data.password  # plain password for auth
+                }),
+                return_exceptions=True
+            )
 
+            if isinstance(auth_response, BaseException):
+                raise auth_response
             if not auth_response.user:
                 raise Exception("Supabase auth signup failed")
+            if isinstance(hashed_password, BaseException):
+                await self._delete_auth_user(auth_response.user.id)
+                raise hashed_password
 
             # Insert user data in users table
             db_user_data = {
@@ -121,12 +288,15 @@ class AuthService:
                 "name": user_data.name,
                 "age": user_data.age,
                 "avatar_url": user_data.avatar,
-                "email_verified": False,  # Default to false, will be set to true after verification
-                "created_at": datetime.utcnow().isoformat(),
-                "updated_at": datetime.utcnow().isoformat()
+                "email_verified": False  # Default to false, will be set to true after verification
             }
 
-            user = await self.db.create_user(db_user_data)
+            try:
+                user = await self.db.create_user(db_user_data)
+            except Exception:
+                # Don't leave an auth account behind without a users row
+                await self._delete_auth_user(auth_response.user.id)
+                raise
             user.pop("password_hash", None)
             return user
 
@@ -137,11 +307,22 @@ class AuthService:
                 detail=str(e)
             )
 
+    async def _delete_auth_user(self, user_id: str) -> None:
+        """Roll back a Supabase auth account (requires the service role client)"""
+        if self.db.supabase_service is None:
+            logger.error(f"Cannot roll back auth user {user_id}: service role client not configured")
+            return
+        try:
+            await asyncio.to_thread(self.db.supabase_service.auth.admin.delete_user, user_id)
+            logger.info(f"Rolled back auth user {user_id}")
+        except Exception as e:
+            logger.error(f"Failed to roll back auth user {user_id}: {str(e)}")
+
     async def create_user_from_dict(self, user_data: Dict[str, Any]) -> Dict[str, Any]:
         """Create user from dictionary data (for OAuth)"""
         try:
             # Hash password
-            hashed_password = self.hash_password(user_data["password"])
+            hashed_password = await self.hash_password(user_data["password"])
 
             # For OAuth users, we'll create them directly in the database
             # since they're already authenticated by the OAuth provider
@@ -155,9 +336,7 @@ class AuthService:
                 "name": user_data["name"],
                 "age": user_data["age"],
                 "avatar_url": user_data.get("avatar"),
-                "email_verified": True,  # OAuth users are pre-verified
-                "created_at": datetime.utcnow().isoformat(),
-                "updated_at": datetime.utcnow().isoformat()
+                "email_verified": user_data.get("email_verified", True)  # from Google's email_verified claim; True is only a fallback
             }
 
             user = await self.db.create_user(db_user_data)
@@ -178,11 +357,24 @@ class AuthService:
             user = await self.db.get_user_by_email(email)
             
             if not user:
+                # Burn the same hashing time as a real check so response timing doesn't reveal
+                # whether the account exists
+                await self.verify_password(password, _DUMMY_HASH)
                 logger.warning(f"Authentication failed: User not found for email {email}")
                 return None
             
             # Verify password first
-            if email == "demo@safedoser.com" or self.verify_password(password, user.get("password_hash", "")):
+            password_hash = user.get("password_hash", "")
+            is_demo = DEMO_LOGIN_ENABLED and _is_demo_email(email)
+            if is_demo or await self.verify_password(password, password_hash):
+                # Lazily upgrade legacy bcrypt (or outdated Argon2) hashes now that we have the plaintext
+                if password_hash and not is_demo and self.password_needs_rehash(password_hash):
+                    try:
+                        await self.db.update_user(user["id"], {"password_hash": await self.hash_password(password)})
+                        logger.info(f"Upgraded password hash for {email}")
+                    except Exception as e:
+                        logger.warning(f"Password hash upgrade failed for {email}: {str(e)}")
+                
                 # Remove sensitive data
                 user.pop("password_hash", None)
                 logger.info(f"Authentication successful for {email}")
@@ -204,11 +396,7 @@ class AuthService:
     
     async def get_user_by_id(self, user_id: str) -> Optional[Dict[str, Any]]:
         """Get user by ID"""
-        user = await self.db.get_user_by_id(user_id)
-        if user:
-            # Remove sensitive data
-            user.pop("password_hash", None)
-        return user
+        return await self.db.get_user_by_id(user_id)
     
     async def get_user_by_id_with_verification_check(self, user_id: str) -> Optional[Dict[str, Any]]:
         """Get user by ID and check email verification status, auto-send verification if needed"""
@@ -217,7 +405,7 @@ class AuthService:
             return None
             
         # Check if email is verified (skip for demo user)
-        if user.get("email") != "demo@safedoser.com" and not user.get("email_verified", False):
+        if not user.get("email_verified", False) and not _is_demo_email(user.get("email")):
             logger.warning(f"Token validation failed: Email not verified for user {user_id}")
             
             raise HTTPException(
@@ -225,8 +413,6 @@ class AuthService:
                 detail="Email not verified."
             )
         
-        # Remove sensitive data
-        user.pop("password_hash", None)
         return user
     
     
@@ -235,7 +421,7 @@ class AuthService:
         try:
             # Handle password update
             if "password" in update_data:
-                update_data["password_hash"] = self.hash_password(update_data.pop("password"))
+                update_data["password_hash"] = await self.hash_password(update_data.pop("password"))
             
             # Handle avatar update
             if "avatar" in update_data:
@@ -243,6 +429,7 @@ class AuthService:
                 update_data["avatar_url"] = update_data.pop("avatar")
             
             user = await self.db.update_user(user_id, update_data)
+            invalidate_user_cache(user_id)
             
             # Remove sensitive data
             user.pop("password_hash", None)
@@ -264,7 +451,8 @@ class AuthService:
                 logger.error("Supabase client is not initialized in the database instance")
                 return False
 
-            result = self.db.supabase.rpc('mark_user_email_verified', {'user_email': email}).execute()
+            result = await _execute(self.db.supabase.rpc('mark_user_email_verified', {'user_email': email}))
+            self.db.invalidate_cached_user(email=email)
             
             if result.data:
                 logger.info(f"Email marked as verified for {email}")
@@ -277,17 +465,35 @@ class AuthService:
             logger.error(f"Error marking email as verified for {email}: {str(e)}")
             return False
 
+_auth_service: Optional[AuthService] = None
+
+def get_auth_service(db: Database = Depends(get_database)) -> AuthService:
+    """Get the auth service, reusing the existing instance while the database instance is the same"""
+    global _auth_service
+    if _auth_service is None or _auth_service.db is not db:
+        _auth_service = AuthService(db)
+    return _auth_service
+
 # Dependency to get current user with email verification check and auto-resend
 async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Database = Depends(get_database)
+    auth_service: AuthService = Depends(get_auth_service)
 ) -> Dict[str, Any]:
     """Get current authenticated user with email verification check and auto-resend"""
     try:
-        auth_service = AuthService(db)
+        token = credentials.credentials
+        cached = _user_cache.get(token)
+        if cached is not None and cached[1] > time.time():
+            return cached[0]
         
         # Verify access token
-        user_id = auth_service.verify_access_token(credentials.credentials)
+        claims = auth_service._decode_token_claims(token, "access")
+        if claims is None:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Invalid token"
+            )
+        user_id, exp = claims
         
         # Get user data with verification check (will auto-send email if needed)
         user = await auth_service.get_user_by_id_with_verification_check(user_id)
@@ -298,6 +504,7 @@ async def get_current_user(
                 detail="User not found"
             )
         
+        _user_cache[token] = (user, exp)
         return user
         
     except HTTPException:
@@ -311,14 +518,32 @@ async def get_current_user(
 
 # Optional user dependency (doesn't raise error if not authenticated)
 async def get_current_user_optional(
-    credentials: Optional[HTTPAuthorizationCredentials] = Depends(security),
-    db: Database = Depends(get_database)
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security),
+    auth_service: AuthService = Depends(get_auth_service)
 ) -> Optional[Dict[str, Any]]:
     """Get current user if authenticated, otherwise return None"""
     if not credentials:
         return None
     
+    # Same checks as get_current_user, but every failure path returns None instead of
+    # raising and catching an HTTPException
+    token = credentials.credentials
+    cached = _user_cache.get(token)
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
+    
+    claims = auth_service._decode_token_claims(token, "access")
+    if claims is None:
+        return None
+    
     try:
-        return await get_current_user(credentials, db)
-    except HTTPException:
-        return None
\ No newline at end of file
+        user = await auth_service.db.get_user_by_id(claims[0])
+    except Exception as e:
+        logger.error(f"Get optional user error: {str(e)}")
+        return None
+    
+    if not user or not (user.get("email_verified", False) or _is_demo_email(user.get("email"))):
+        return None
+    
+    _user_cache[token] = (user, claims[1])
+    return user
\ No newline at end of file
@@ -4,25 +4,147 @@ Handles all database operations using Supabase
 """
 
 import os
+import asyncio
 import logging
-from datetime import datetime, date, timedelta
-from typing import Optional, Dict, Any, List
-import json
+from datetime import datetime, date, timedelta, timezone
+from typing import Optional, Dict, Any, List, Tuple, Callable, Awaitable
+import asyncpg
+import httpx
+import orjson
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from supabase import create_client, Client
+from supabase import create_client, Client, SupabaseAuthClient
+from postgrest.types import CountMethod, ReturnMethod
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+# Per-worker cache of parsed supplement lists keyed by user_id, then by column projection.
+# Supplements change far less often than they are read (every chat message builds its context
+# from them), and every supplement write below invalidates the owner's entry; the TTL bounds
+# staleness across workers.
+_supplements_cache: TTLCache = TTLCache(maxsize=10000, ttl=60)
+
+# Per-worker cache of public user rows keyed by user_id. Every authenticated request looks its
+# user up by ID, but rows change rarely; writes that go through this module drop the entry, the
+# TTL bounds staleness across workers. Misses are never cached, so a new signup is visible
+# immediately. Concurrent misses for the same key share one query. Lookups by email are not
+# cached: they feed login/reset (password_hash) and are driven by unauthenticated input.
+USER_ROW_CACHE_TTL_SECONDS = 30
+_users_by_id_cache: TTLCache = TTLCache(maxsize=10000, ttl=USER_ROW_CACHE_TTL_SECONDS)
+_user_lookups_in_flight: Dict[str, "asyncio.Future[Optional[Dict[str, Any]]]"] = {}
+
+async def _coalesced(key: str, fetch: Callable[[], Awaitable[Optional[Dict[str, Any]]]]) -> Optional[Dict[str, Any]]:
+    """Run fetch() once for all concurrent callers asking for the same key"""
+    pending = _user_lookups_in_flight.get(key)
+    if pending is None:
+        pending = asyncio.ensure_future(fetch())
+        _user_lookups_in_flight[key] = pending
+        pending.add_done_callback(lambda _: _user_lookups_in_flight.pop(key, None))
+    # shield: one caller going away must not cancel the lookup the others are waiting on
+    return await asyncio.shield(pending)
+
+# Recent assistant replies keyed by a hash of (user, normalized question, supplement list), so a
+# repeated question skips the model call. Per worker; entries simply age out.
+CHAT_RESPONSE_CACHE_TTL_SECONDS = 600
+_chat_response_cache: TTLCache = TTLCache(maxsize=10000, ttl=CHAT_RESPONSE_CACHE_TTL_SECONDS)
+
+# Columns returned for user lookups by ID (every authenticated request). password_hash is left
+# out on purpose; only the email lookup used for login needs it.
+USER_PUBLIC_COLUMNS = "id,email,name,age,avatar_url,email_verified,chat_cleared_at,created_at,updated_at"
+USER_AUTH_COLUMNS = USER_PUBLIC_COLUMNS + ",password_hash"
+
+# Explicit projections for the hot list/detail reads: exactly what the API models return
+SUPPLEMENT_COLUMNS = (
+    "id,user_id,name,brand,dosage_form,dose_quantity,dose_unit,frequency,times_of_day,"
+    "interactions,remind_me,expiration_date,quantity,image_url,created_at,updated_at"
+)
+CHAT_MESSAGE_COLUMNS = "id,user_id,sender,message,context,timestamp"
+# What the AI chat context needs from each supplement (it is also stored with every message)
+SUPPLEMENT_CHAT_COLUMNS = "id,name,brand,dosage_form,dose_quantity,dose_unit,frequency"
+
+# Direct Postgres pool settings (used when SUPABASE_DB_URL is set). Prepared statements are never
+# cached, so the same DSN works against Supavisor/pgbouncer in transaction mode ("prepared
+# statement does not exist") as well as session mode or a direct connection. The idle floor is
+# small so several workers stay under the project's pooler connection cap.
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "50"))
+
+# Shared PostgREST HTTP pool: HTTP/2 keep-alive connections that stay warm between requests, so
+# queries reuse an open TLS session instead of handshaking
+POSTGREST_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=50, max_connections=100, keepalive_expiry=30.0)
+POSTGREST_HTTP_TIMEOUT = httpx.Timeout(10.0)
+
+def _use_pooled_postgrest_session(client: Client) -> None:
+    """Swap the client's PostgREST session for an HTTP/2 one with explicit pool limits"""
+    postgrest = client.postgrest
+    default_session = postgrest.session
+    postgrest.session = httpx.Client(
+        base_url=default_session.base_url,
+        headers=default_session.headers,
+        http2=True,
+        limits=POSTGREST_HTTP_LIMITS,
+        timeout=POSTGREST_HTTP_TIMEOUT,
+        follow_redirects=True
+    )
+    default_session.close()
+
+def _decode_timestamptz(v: str) -> str:
+    """Postgres text timestamptz to PostgREST's ISO form: "2024-01-01 10:00:00+00" becomes
+    "2024-01-01T10:00:00+00:00" (Postgres drops the minutes of a whole-hour offset)"""
+    v = v.replace(" ", "T", 1)
+    return v + ":00" if v[-3:-2] in ("+", "-") else v
+
+async def _init_connection(conn: asyncpg.Connection) -> None:
+    """Make asyncpg rows look like PostgREST rows (string uuids/timestamps, decoded JSON)"""
+    for json_type in ("json", "jsonb"):
+        await conn.set_type_codec(
+            json_type, schema="pg_catalog", format="text",
+            encoder=lambda v: orjson.dumps(v).decode(), decoder=orjson.loads
+        )
+    await conn.set_type_codec("uuid", schema="pg_catalog", format="text", encoder=str, decoder=str)
+    for temporal_type in ("date", "timestamp"):
+        await conn.set_type_codec(
+            temporal_type, schema="pg_catalog", format="text",
+            encoder=str, decoder=lambda v: v.replace(" ", "T", 1)
+        )
+    await conn.set_type_codec(
+        "timestamptz", schema="pg_catalog", format="text", encoder=str, decoder=_decode_timestamptz
+    )
+
+async def _execute(query):
+    """Run a supabase-py query (a blocking httpx call) on a worker thread.
+
+    Keeps the event loop free while PostgREST answers and lets independent reads issued with
+    asyncio.gather overlap.
+    """
+    return await asyncio.to_thread(query.execute)
+
+def _utc_day_bounds(target_date: date) -> Tuple[str, str]:
+    """Half-open [midnight, next midnight) UTC bounds for created_at filters on a calendar day"""
+    start = datetime.combine(target_date, datetime.min.time(), tzinfo=timezone.utc)
+    return start.isoformat(), (start + timedelta(days=1)).isoformat()
+
+def _to_json_compatible(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert datetimes/dates (naive ones as UTC) to ISO strings in a single orjson C pass"""
+    return orjson.loads(orjson.dumps(data, option=orjson.OPT_NAIVE_UTC))
+
 class Database:
     """Database service for SafeDoser using Supabase"""
     
+    # Supplement jsonb columns, with the Python type they hold (see migrations/003)
+    _JSON_FIELDS = (("times_of_day", dict), ("interactions", list))
+    
     def __init__(self):
         self.supabase_url = os.getenv("SUPABASE_URL")
         self.supabase_anon_key = os.getenv("SUPABASE_ANON_KEY")
         self.supabase_service_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+        self.db_url = os.getenv("SUPABASE_DB_URL")
         self.supabase: Optional[Client] = None
         self.supabase_service: Optional[Client] = None
+        self.pool: Optional[asyncpg.Pool] = None
+        # Connection pool behind the throwaway sign-up auth clients (see new_auth_client)
+        self._auth_http: Optional[httpx.Client] = None
         
         if not self.supabase_url or not self.supabase_anon_key:
             logger.error("Missing Supabase configuration")
@@ -36,150 +158,128 @@ class Database:
             
             # Initialize anon client for regular operations
             self.supabase = create_client(str(self.supabase_url), str(self.supabase_anon_key))
+            _use_pooled_postgrest_session(self.supabase)
+            
+            self._auth_http = httpx.Client(
+                http2=True,
+                limits=POSTGREST_HTTP_LIMITS,
+                timeout=POSTGREST_HTTP_TIMEOUT,
+                follow_redirects=True
+            )
             
             # Initialize service client for admin operations if service key is available
             if self.supabase_service_key:
                 self.supabase_service = create_client(str(self.supabase_url), str(self.supabase_service_key))
+                _use_pooled_postgrest_session(self.supabase_service)
                 logger.info("Database initialized with service role access")
             else:
                 logger.warning("No service role key provided - some operations may fail")
+            
+            # Hot read paths skip PostgREST and query Postgres directly when a DSN is configured
+            if self.db_url:
+                self.pool = await asyncpg.create_pool(
+                    self.db_url,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    max_inactive_connection_lifetime=300,
+                    statement_cache_size=0,
+                    max_cached_statement_lifetime=0,
+                    server_settings={"timezone": "UTC", "jit": "off"},
+                    init=_init_connection
+                )
+                logger.info(f"Postgres connection pool created (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE})")
                 
             logger.info("Database initialized successfully")
         except Exception as e:
             logger.error(f"Database initialization failed: {str(e)}")
             raise
     
-    def set_auth_token(self, token: str):
-        """Set authentication token for the current session"""
-        if self.supabase:
-            self.supabase.auth.set_session(token, "")
+    def new_auth_client(self) -> SupabaseAuthClient:
+        """A fresh, session-less auth client for calls that sign a user in (sign_up).
+
+        A successful sign-in on the shared anon client would store that user's session and make
+        supabase-py rewrite the client's Authorization header, so every later PostgREST query in
+        the process would run as that user. The throwaway client keeps the session to itself and
+        only shares the HTTP connection pool.
+        """
+        return SupabaseAuthClient(
+            url=f"{self.supabase_url}/auth/v1",
+            headers={"apiKey": str(self.supabase_anon_key), "Authorization": f"Bearer {self.supabase_anon_key}"},
+            auto_refresh_token=False,
+            persist_session=False,
+            http_client=self._auth_http
+        )
     
     async def close(self):
         """Close database connection"""
-        # Supabase client doesn't need explicit closing
+        for client in (self.supabase, self.supabase_service):
+            if client is not None:
+                client.postgrest.session.close()
+        if self._auth_http is not None:
+            self._auth_http.close()
+            self._auth_http = None
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
         logger.info("Database connection closed")
     
-    def _serialize_for_json(self, data: Any) -> Any:
-        """Convert data types that aren't JSON serializable"""
-        if isinstance(data, dict):
-            return {key: self._serialize_for_json(value) for key, value in data.items()}
-        elif isinstance(data, list):
-            return [self._serialize_for_json(item) for item in data]
-        elif isinstance(data, date):
-            return data.isoformat()
-        elif isinstance(data, datetime):
-            return data.isoformat()
-        else:
-            return data
-    
     def _prepare_supplement_data(self, supplement_data: Dict[str, Any]) -> Dict[str, Any]:
-        """Prepare supplement data for database insertion"""
-        logger.debug(f"Preparing supplement data: {supplement_data}")
-        
-        # Create a copy to avoid modifying the original
-        prepared_data = supplement_data.copy()
-        
-        # Handle times_of_day - convert to JSON string if it's a dict
-        if 'times_of_day' in prepared_data:
-            times_data = prepared_data['times_of_day']
-            logger.debug(f"Original times_of_day type: {type(times_data)}, value: {times_data}")
-            
-            if isinstance(times_data, dict):
-                # Convert datetime objects to ISO strings
-                serialized_times = {}
-                for period, times_list in times_data.items():
-                    if isinstance(times_list, list):
-                        serialized_times[period] = [
-                            time.isoformat() if isinstance(time, (datetime, date)) else str(time)
-                            for time in times_list
-                        ]
-                    else:
-                        serialized_times[period] = times_list
-                
-                prepared_data['times_of_day'] = json.dumps(serialized_times)
-                logger.debug(f"Serialized times_of_day: {prepared_data['times_of_day']}")
-        
-        # Handle interactions - convert to JSON string if it's a list
-        if 'interactions' in prepared_data:
-            interactions = prepared_data['interactions']
-            logger.debug(f"Original interactions type: {type(interactions)}, value: {interactions}")
-            
-            if isinstance(interactions, list):
-                prepared_data['interactions'] = json.dumps(interactions)
-                logger.debug(f"Serialized interactions: {prepared_data['interactions']}")
-        
-        # Handle expiration_date - ensure it's a string
-        if 'expiration_date' in prepared_data:
-            exp_date = prepared_data['expiration_date']
-            logger.debug(f"Original expiration_date type: {type(exp_date)}, value: {exp_date}")
-            
-            if isinstance(exp_date, (datetime, date)):
-                prepared_data['expiration_date'] = exp_date.isoformat()
-            elif exp_date is not None:
-                prepared_data['expiration_date'] = str(exp_date)
-            
-            logger.debug(f"Prepared expiration_date: {prepared_data['expiration_date']}")
+        """Prepare supplement data for database insertion.
+
+        times_of_day/interactions are jsonb columns, so they are sent as-is inside the request
+        body; only date/datetime values need converting. Returns a new dict.
+        """
+        logger.debug("Preparing supplement data: %s", supplement_data)
         
-        # Ensure all other fields are properly serialized
-        prepared_data = self._serialize_for_json(prepared_data)
+        # Ensure all fields (expiration_date included) are properly serialized
+        prepared_data = _to_json_compatible(supplement_data)
         
-        logger.debug(f"Final prepared supplement data: {prepared_data}")
+        logger.debug("Final prepared supplement data: %s", prepared_data)
         return prepared_data
     
+    def _parse_json_fields(self, row: Dict[str, Any]) -> Dict[str, Any]:
+        """Default empty or malformed JSON fields of a supplement row in place (fields not selected are skipped)"""
+        for name, field_type in self._JSON_FIELDS:
+            if name not in row:
+                continue
+            value = row[name]
+            if not value:
+                row[name] = field_type()
+            elif not isinstance(value, field_type):
+                logger.warning(f"{name} is not a {field_type.__name__} for supplement {row.get('id')}")
+                row[name] = field_type()
+        return row
+    
     def _parse_supplement_response(self, supplement: Dict[str, Any]) -> Dict[str, Any]:
-        """Parse supplement data from database response for API response"""
-        logger.debug(f"Parsing supplement response: {supplement.get('id', 'unknown')}")
-        
-        # Create a copy to avoid modifying the original
-        parsed_supplement = supplement.copy()
+        """Parse supplement data from database response for API response (in place; rows are fresh)"""
+        logger.debug("Parsing supplement response: %s", supplement.get('id', 'unknown'))
         
-        # Parse times_of_day JSON string back to dict
-        if parsed_supplement.get('times_of_day'):
-            if isinstance(parsed_supplement['times_of_day'], str):
-                try:
-                    parsed_supplement['times_of_day'] = json.loads(parsed_supplement['times_of_day'])
-                    logger.debug(f"Parsed times_of_day from string: {parsed_supplement['times_of_day']}")
-                except json.JSONDecodeError as e:
-                    logger.warning(f"Failed to parse times_of_day for supplement {supplement.get('id')}: {e}")
-                    parsed_supplement['times_of_day'] = {}
-            elif not isinstance(parsed_supplement['times_of_day'], dict):
-                logger.warning(f"times_of_day is not a dict or string for supplement {supplement.get('id')}")
-                parsed_supplement['times_of_day'] = {}
-        else:
-            parsed_supplement['times_of_day'] = {}
-        
-        # Parse interactions JSON string back to list
-        if parsed_supplement.get('interactions'):
-            if isinstance(parsed_supplement['interactions'], str):
-                try:
-                    parsed_supplement['interactions'] = json.loads(parsed_supplement['interactions'])
-                    logger.debug(f"Parsed interactions from string: {parsed_supplement['interactions']}")
-                except json.JSONDecodeError as e:
-                    logger.warning(f"Failed to parse interactions for supplement {supplement.get('id')}: {e}")
-                    parsed_supplement['interactions'] = []
-            elif not isinstance(parsed_supplement['interactions'], list):
-                logger.warning(f"interactions is not a list or string for supplement {supplement.get('id')}")
-                parsed_supplement['interactions'] = []
-        else:
-            parsed_supplement['interactions'] = []
-        
-        logger.debug(f"Final parsed supplement: {parsed_supplement.get('id', 'unknown')}")
-        return parsed_supplement
+        return self._parse_json_fields(supplement)
+    
+    def _parse_supplements_bulk(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Parse a freshly fetched list of supplement rows in place"""
+        parse = self._parse_json_fields
+        for row in rows:
+            parse(row)
+        return rows
     
     # User operations
+    def invalidate_cached_user(self, user_id: Optional[str] = None, email: Optional[str] = None) -> None:
+        """Drop a user's cached row after a write, by ID or (when only that is known) by email"""
+        if user_id is None and email is not None:
+            user_id = next((uid for uid, user in list(_users_by_id_cache.items()) if user.get("email") == email), None)
+        if user_id is not None:
+            _users_by_id_cache.pop(user_id, None)
+    
     async def create_user(self, user_data: Dict[str, Any]) -> Dict[str, Any]:
         """Create a new user"""
         try:
-            logger.debug(f"Creating user with data: {user_data}")
+            logger.debug("Creating user with data: %s", user_data)
 
-            # Ensure Supabase client is initialized
-            if self.supabase is None:
-                self.supabase = create_client(str(self.supabase_url), str(self.supabase_anon_key))
-            
             # Serialize the data
-            serialized_data = self._serialize_for_json(user_data)
+            serialized_data = _to_json_compatible(user_data)
             
-            result = self.supabase.table("users").insert(serialized_data).execute()
+            result = await _execute(self.supabase.table("users").insert(serialized_data))
             
             if result.data:
                 logger.info(f"User created successfully: {result.data[0]['id']}")
@@ -195,19 +295,21 @@ class Database:
     async def get_user_by_email(self, email: str) -> Optional[Dict[str, Any]]:
         """Get user by email"""
         try:
-            logger.debug(f"Getting user by email: {email}")
+            logger.debug("Getting user by email: %s", email)
 
-            # Ensure Supabase client is initialized
-            if self.supabase is None:
-                self.supabase = create_client(str(self.supabase_url), str(self.supabase_anon_key))
-            
-            result = self.supabase.table("users").select("*").eq("email", email).execute()
+            if self.pool is not None:
+                row = await self.pool.fetchrow(f"SELECT {USER_AUTH_COLUMNS} FROM users WHERE email = $1", email)
+                user = dict(row) if row is not None else None
+            else:
+                # maybe_single() returns the row itself (or None) instead of a one-element array
+                result = await _execute(self.supabase.table("users").select(USER_AUTH_COLUMNS).eq("email", email).maybe_single())
+                user = result.data if result is not None else None
             
-            if result.data:
-                logger.debug(f"User found: {result.data[0]['id']}")
-                return result.data[0]
+            if user:
+                logger.debug("User found: %s", user['id'])
+                return user
             else:
-                logger.debug(f"No user found with email: {email}")
+                logger.debug("No user found with email: %s", email)
                 return None
                 
         except Exception as e:
@@ -215,21 +317,30 @@ class Database:
             raise
     
     async def get_user_by_id(self, user_id: str) -> Optional[Dict[str, Any]]:
-        """Get user by ID"""
+        """Get user by ID (public columns only, no password_hash; cached, returns a copy)"""
+        cached = _users_by_id_cache.get(user_id)
+        if cached is None:
+            cached = await _coalesced(f"id:{user_id}", lambda: self._fetch_user_by_id(user_id))
+        return dict(cached) if cached is not None else None
+    
+    async def _fetch_user_by_id(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Look a user up by ID and cache the row"""
         try:
-            logger.debug(f"Getting user by ID: {user_id}")
+            logger.debug("Getting user by ID: %s", user_id)
 
-            # Ensure Supabase client is initialized
-            if self.supabase is None:
-                self.supabase = create_client(str(self.supabase_url), str(self.supabase_anon_key))
-            
-            result = self.supabase.table("users").select("*").eq("id", user_id).execute()
+            if self.pool is not None:
+                row = await self.pool.fetchrow(f"SELECT {USER_PUBLIC_COLUMNS} FROM users WHERE id = $1", user_id)
+                user = dict(row) if row is not None else None
+            else:
+                result = await _execute(self.supabase.table("users").select(USER_PUBLIC_COLUMNS).eq("id", user_id).maybe_single())
+                user = result.data if result is not None else None
             
-            if result.data:
-                logger.debug(f"User found: {result.data[0]['id']}")
-                return result.data[0]
+            if user:
+                logger.debug("User found: %s", user['id'])
+                _users_by_id_cache[user_id] = user
+                return user
             else:
-                logger.debug(f"No user found with ID: {user_id}")
+                logger.debug("No user found with ID: %s", user_id)
                 return None
                 
         except Exception as e:
@@ -239,19 +350,13 @@ class Database:
     async def update_user(self, user_id: str, update_data: Dict[str, Any]) -> Dict[str, Any]:
         """Update user data"""
         try:
-            logger.debug(f"Updating user {user_id} with data: {update_data}")
-            
-            # Add updated_at timestamp
-            update_data["updated_at"] = datetime.utcnow().isoformat()
-            
-            # Ensure Supabase client is initialized
-            if self.supabase is None:
-                self.supabase = create_client(str(self.supabase_url), str(self.supabase_anon_key))
+            logger.debug("Updating user %s with data: %s", user_id, update_data)
             
             # Serialize the data
-            serialized_data = self._serialize_for_json(update_data)
+            serialized_data = _to_json_compatible(update_data)
             
-            result = self.supabase.table("users").update(serialized_data).eq("id", user_id).execute()
+            result = await _execute(self.supabase.table("users").update(serialized_data).eq("id", user_id))
+            self.invalidate_cached_user(user_id=user_id)
             
             if result.data:
                 logger.info(f"User updated successfully: {user_id}")
@@ -269,32 +374,27 @@ class Database:
         """Create a new supplement"""
         try:
             logger.info(f"Creating supplement for user {user_id}")
-            logger.debug(f"Raw supplement data: {supplement_data}")
+            logger.debug("Raw supplement data: %s", supplement_data)
             
-            # Add user_id and timestamps
+            # Add user_id (created_at/updated_at are filled in by the database)
             supplement_data["user_id"] = user_id
-            supplement_data["created_at"] = datetime.utcnow().isoformat()
-            supplement_data["updated_at"] = datetime.utcnow().isoformat()
-            
-            # Ensure Supabase client is initialized
-            if self.supabase is None:
-                self.supabase = create_client(str(self.supabase_url), str(self.supabase_anon_key))
             
             # Prepare data for database insertion
             prepared_data = self._prepare_supplement_data(supplement_data)
             
-            logger.debug(f"Inserting supplement data into database: {prepared_data}")
+            logger.debug("Inserting supplement data into database: %s", prepared_data)
             
-            result = self.supabase.table("supplements").insert(prepared_data).execute()
+            result = await _execute(self.supabase.table("supplements").insert(prepared_data))
             
             if result.data:
                 created_supplement = result.data[0]
+                _supplements_cache.pop(user_id, None)
                 logger.info(f"Supplement created successfully: {created_supplement['id']}")
-                logger.debug(f"Raw created supplement data: {created_supplement}")
+                logger.debug("Raw created supplement data: %s", created_supplement)
                 
-                # Parse the response for API return (convert JSON strings back to objects)
+                # jsonb fields come back as objects already
                 parsed_supplement = self._parse_supplement_response(created_supplement)
-                logger.debug(f"Parsed supplement for API response: {parsed_supplement}")
+                logger.debug("Parsed supplement for API response: %s", parsed_supplement)
                 
                 return parsed_supplement
             else:
@@ -306,27 +406,32 @@ class Database:
             logger.error(f"Failed supplement data: {supplement_data}")
             raise
     
-    async def get_user_supplements(self, user_id: str) -> List[Dict[str, Any]]:
-        """Get all supplements for a user"""
+    async def get_user_supplements(self, user_id: str, columns: str = SUPPLEMENT_COLUMNS) -> List[Dict[str, Any]]:
+        """Get all supplements for a user, selecting only `columns` (the full API shape by default)"""
         try:
-            logger.debug(f"Getting supplements for user: {user_id}")
-            
-            # Ensure Supabase client is initialized
-            if self.supabase is None:
-                self.supabase = create_client(str(self.supabase_url), str(self.supabase_anon_key))
-            
-            result = self.supabase.table("supplements").select("*").eq("user_id", user_id).order("created_at", desc=False).execute()
-            
-            supplements = result.data or []
-            logger.debug(f"Found {len(supplements)} supplements for user {user_id}")
+            cached = _supplements_cache.get(user_id, {}).get(columns)
+            if cached is not None:
+                logger.debug("Supplements cache hit for user: %s", user_id)
+                # Shallow copies, so a caller editing a supplement dict can't corrupt the cache
+                return [dict(s) for s in cached]
+            
+            logger.debug("Getting supplements for user: %s", user_id)
+            
+            if self.pool is not None:
+                rows = await self.pool.fetch(
+                    f"SELECT {columns} FROM supplements WHERE user_id = $1 ORDER BY created_at", user_id
+                )
+                supplements = [dict(row) for row in rows]
+            else:
+                result = await _execute(self.supabase.table("supplements").select(columns).eq("user_id", user_id).order("created_at", desc=False))
+                supplements = result.data or []
+            logger.debug("Found %s supplements for user %s", len(supplements), user_id)
             
             # Parse JSON fields for all supplements
-            parsed_supplements = []
-            for supplement in supplements:
-                parsed_supplement = self._parse_supplement_response(supplement)
-                parsed_supplements.append(parsed_supplement)
+            parsed_supplements = self._parse_supplements_bulk(supplements)
             
-            return parsed_supplements
+            _supplements_cache.setdefault(user_id, {})[columns] = parsed_supplements
+            return [dict(s) for s in parsed_supplements]
             
         except Exception as e:
             logger.error(f"Get user supplements error: {str(e)}")
@@ -335,56 +440,56 @@ class Database:
     async def get_supplement_by_id(self, supplement_id: int) -> Optional[Dict[str, Any]]:
         """Get supplement by ID"""
         try:
-            logger.debug(f"Getting supplement by ID: {supplement_id}")
+            logger.debug("Getting supplement by ID: %s", supplement_id)
 
-            # Ensure Supabase client is initialized
-            if self.supabase is None:
-                self.supabase = create_client(str(self.supabase_url), str(self.supabase_anon_key))
-            
-            result = self.supabase.table("supplements").select("*").eq("id", supplement_id).execute()
+            if self.pool is not None:
+                row = await self.pool.fetchrow(f"SELECT {SUPPLEMENT_COLUMNS} FROM supplements WHERE id = $1", supplement_id)
+                supplement = dict(row) if row is not None else None
+            else:
+                result = await _execute(self.supabase.table("supplements").select(SUPPLEMENT_COLUMNS).eq("id", supplement_id).maybe_single())
+                supplement = result.data if result is not None else None
             
-            if result.data:
-                supplement = result.data[0]
-                logger.debug(f"Supplement found: {supplement['id']}")
+            if supplement:
+                logger.debug("Supplement found: %s", supplement['id'])
                 
                 # Parse JSON fields
                 parsed_supplement = self._parse_supplement_response(supplement)
                 return parsed_supplement
             else:
-                logger.debug(f"No supplement found with ID: {supplement_id}")
+                logger.debug("No supplement found with ID: %s", supplement_id)
                 return None
                 
         except Exception as e:
             logger.error(f"Get supplement by ID error: {str(e)}")
             raise
     
-    async def update_supplement(self, supplement_id: int, update_data: Dict[str, Any]) -> Dict[str, Any]:
-        """Update supplement data"""
+    async def update_supplement(self, supplement_id: int, update_data: Dict[str, Any], user_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Update supplement data; with user_id, only a supplement owned by that user is updated"""
         try:
             logger.info(f"Updating supplement {supplement_id}")
-            logger.debug(f"Update data: {update_data}")
-            
-            # Add updated_at timestamp
-            update_data["updated_at"] = datetime.utcnow().isoformat()
-            
-            # Ensure Supabase client is initialized
-            if self.supabase is None:
-                self.supabase = create_client(str(self.supabase_url), str(self.supabase_anon_key))
+            logger.debug("Update data: %s", update_data)
             
             # Prepare data for database update
             prepared_data = self._prepare_supplement_data(update_data)
             
-            logger.debug(f"Prepared update data: {prepared_data}")
+            logger.debug("Prepared update data: %s", prepared_data)
             
-            result = self.supabase.table("supplements").update(prepared_data).eq("id", supplement_id).execute()
+            query = self.supabase.table("supplements").update(prepared_data).eq("id", supplement_id)
+            if user_id is not None:
+                query = query.eq("user_id", user_id)
+            result = await _execute(query)
             
             if result.data:
                 updated_supplement = result.data[0]
+                _supplements_cache.pop(updated_supplement.get("user_id"), None)
                 logger.info(f"Supplement updated successfully: {supplement_id}")
                 
-                # Parse JSON fields for return
+                # jsonb fields come back as objects already
                 parsed_supplement = self._parse_supplement_response(updated_supplement)
                 return parsed_supplement
+            elif user_id is not None:
+                logger.warning(f"No supplement {supplement_id} owned by user {user_id} to update")
+                return None
             else:
                 logger.error(f"Failed to update supplement: {supplement_id}")
                 raise Exception("Failed to update supplement")
@@ -394,18 +499,21 @@ class Database:
             logger.error(f"Failed update data: {update_data}")
             raise
     
-    async def delete_supplement(self, supplement_id: int) -> bool:
-        """Delete a supplement"""
+    async def delete_supplement(self, supplement_id: int, user_id: Optional[str] = None) -> bool:
+        """Delete a supplement; with user_id, only a supplement owned by that user is deleted"""
         try:
             logger.info(f"Deleting supplement: {supplement_id}")
 
-            # Ensure Supabase client is initialized
-            if self.supabase is None:
-                self.supabase = create_client(str(self.supabase_url), str(self.supabase_anon_key))
-            
-            result = self.supabase.table("supplements").delete().eq("id", supplement_id).execute()
-            
-            if result.data:
+            # Only the affected-row count is needed when the owner is already known; otherwise the
+            # deleted row is returned so its owner's cache entry can be invalidated
+            returning = ReturnMethod.minimal if user_id is not None else ReturnMethod.representation
+            query = self.supabase.table("supplements").delete(count=CountMethod.exact, returning=returning).eq("id", supplement_id)
+            if user_id is not None:
+                query = query.eq("user_id", user_id)
+            result = await _execute(query)
+            
+            if result.count:
+                _supplements_cache.pop(user_id if user_id is not None else result.data[0].get("user_id"), None)
                 logger.info(f"Supplement deleted successfully: {supplement_id}")
                 return True
             else:
@@ -421,21 +529,15 @@ class Database:
         """Create a new supplement log"""
         try:
             logger.info(f"Creating supplement log for user {log_data.get('user_id')}")
-            logger.debug(f"Log data: {log_data}")
-            
-            # Add timestamp
-            log_data["created_at"] = datetime.utcnow().isoformat()
+            logger.debug("Log data: %s", log_data)
             
             # Use service client if available for RLS bypass, otherwise use regular client
             client = self.supabase_service if self.supabase_service else self.supabase
             
-            if client is None:
-                client = create_client(str(self.supabase_url), str(self.supabase_service_key or self.supabase_anon_key))
-            
             # Serialize the data
-            serialized_data = self._serialize_for_json(log_data)
+            serialized_data = _to_json_compatible(log_data)
             
-            result = client.table("supplement_logs").insert(serialized_data).execute()
+            result = await _execute(client.table("supplement_logs").insert(serialized_data))
             
             if result.data:
                 logger.info(f"Supplement log created successfully: {result.data[0]['id']}")
@@ -448,25 +550,28 @@ class Database:
             logger.error(f"Create supplement log error: {str(e)}")
             raise
     
-    async def get_supplement_logs_by_date(self, user_id: str, target_date: date) -> List[Dict[str, Any]]:
-        """Get supplement logs for a specific date"""
+    async def get_supplement_logs_by_date(self, user_id: str, target_date: date, columns: str = "*") -> List[Dict[str, Any]]:
+        """Get supplement logs for a specific date, selecting only `columns` (all by default)"""
         try:
-            logger.debug(f"Getting supplement logs for user {user_id} on {target_date}")
+            logger.debug("Getting supplement logs for user %s on %s", user_id, target_date)
             
             # Use service client if available, otherwise use regular client
             client = self.supabase_service if self.supabase_service else self.supabase
             
-            if client is None:
-                client = create_client(str(self.supabase_url), str(self.supabase_service_key or self.supabase_anon_key))
-            
             # Get logs for the specific date
-            start_date = target_date.isoformat()
-            end_date = (target_date + timedelta(days=1)).isoformat()
-            
-            result = client.table("supplement_logs").select("*").eq("user_id", user_id).gte("created_at", start_date).lt("created_at", end_date).order("created_at", desc=False).execute()
-            
-            logs = result.data or []
-            logger.debug(f"Found {len(logs)} supplement logs for {target_date}")
+            start_date, end_date = _utc_day_bounds(target_date)
+            
+            if self.pool is not None:
+                rows = await self.pool.fetch(
+                    f"SELECT {columns} FROM supplement_logs WHERE user_id = $1 AND created_at >= $2 AND created_at < $3 "
+                    "ORDER BY created_at",
+                    user_id, start_date, end_date
+                )
+                logs = [dict(row) for row in rows]
+            else:
+                result = await _execute(client.table("supplement_logs").select(columns).eq("user_id", user_id).gte("created_at", start_date).lt("created_at", end_date).order("created_at", desc=False))
+                logs = result.data or []
+            logger.debug("Found %s supplement logs for %s", len(logs), target_date)
             
             return logs
             
@@ -477,21 +582,23 @@ class Database:
     async def get_supplement_log_by_id(self, log_id: str) -> Optional[Dict[str, Any]]:
         """Get supplement log by ID"""
         try:
-            logger.debug(f"Getting supplement log by ID: {log_id}")
+            logger.debug("Getting supplement log by ID: %s", log_id)
             
             # Use service client if available, otherwise use regular client
             client = self.supabase_service if self.supabase_service else self.supabase
             
-            if client is None:
-                client = create_client(str(self.supabase_url), str(self.supabase_service_key or self.supabase_anon_key))
-            
-            result = client.table("supplement_logs").select("*").eq("id", log_id).execute()
+            if self.pool is not None:
+                row = await self.pool.fetchrow("SELECT * FROM supplement_logs WHERE id = $1", log_id)
+                log = dict(row) if row is not None else None
+            else:
+                result = await _execute(client.table("supplement_logs").select("*").eq("id", log_id).maybe_single())
+                log = result.data if result is not None else None
             
-            if result.data:
-                logger.debug(f"Supplement log found: {log_id}")
-                return result.data[0]
+            if log:
+                logger.debug("Supplement log found: %s", log_id)
+                return log
             else:
-                logger.debug(f"No supplement log found with ID: {log_id}")
+                logger.debug("No supplement log found with ID: %s", log_id)
                 return None
                 
         except Exception as e:
@@ -507,51 +614,71 @@ class Database:
     ) -> Optional[Dict[str, Any]]:
         """Get supplement log by supplement ID and scheduled time for a specific date"""
         try:
-            logger.debug(f"Getting supplement log for user {user_id}, supplement {supplement_id}, time {scheduled_time} on {target_date}")
+            logger.debug("Getting supplement log for user %s, supplement %s, time %s on %s", user_id, supplement_id, scheduled_time, target_date)
             
             # Use service client if available, otherwise use regular client
             client = self.supabase_service if self.supabase_service else self.supabase
             
-            if client is None:
-                client = create_client(str(self.supabase_url), str(self.supabase_service_key or self.supabase_anon_key))
-            
             # Get logs for the specific date
-            start_date = target_date.isoformat()
-            end_date = (target_date + timedelta(days=1)).isoformat()
-            
-            result = client.table("supplement_logs").select("*").eq("user_id", user_id).eq("supplement_id", supplement_id).eq("scheduled_time", scheduled_time).gte("created_at", start_date).lt("created_at", end_date).execute()
+            start_date, end_date = _utc_day_bounds(target_date)
+            
+            if self.pool is not None:
+                row = await self.pool.fetchrow(
+                    "SELECT * FROM supplement_logs WHERE user_id = $1 AND supplement_id = $2 AND scheduled_time = $3 "
+                    "AND created_at >= $4 AND created_at < $5 LIMIT 1",
+                    user_id, supplement_id, scheduled_time, start_date, end_date
+                )
+                log = dict(row) if row is not None else None
+            else:
+                result = await _execute(client.table("supplement_logs").select("*").eq("user_id", user_id).eq("supplement_id", supplement_id).eq("scheduled_time", scheduled_time).gte("created_at", start_date).lt("created_at", end_date).limit(1).maybe_single())
+                log = result.data if result is not None else None
             
-            if result.data:
-                logger.debug(f"Supplement log found for supplement {supplement_id} at {scheduled_time}")
-                return result.data[0]
+            if log:
+                logger.debug("Supplement log found for supplement %s at %s", supplement_id, scheduled_time)
+                return log
             else:
-                logger.debug(f"No supplement log found for supplement {supplement_id} at {scheduled_time}")
+                logger.debug("No supplement log found for supplement %s at %s", supplement_id, scheduled_time)
                 return None
                 
         except Exception as e:
             logger.error(f"Get supplement log by supplement and time error: {str(e)}")
             raise
     
-    async def update_supplement_log(self, log_id: str, update_data: Dict[str, Any]) -> Dict[str, Any]:
-        """Update supplement log"""
+    async def update_supplement_log(
+        self,
+        log_id: str,
+        update_data: Dict[str, Any],
+        user_id: Optional[str] = None,
+        exclude_status: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Update supplement log.
+
+        With user_id, only a log owned by that user is updated; with exclude_status, a log
+        already in that status is left untouched. Returns None when no row matched the filters.
+        """
         try:
             logger.info(f"Updating supplement log {log_id}")
-            logger.debug(f"Update data: {update_data}")
+            logger.debug("Update data: %s", update_data)
             
             # Use service client if available, otherwise use regular client
             client = self.supabase_service if self.supabase_service else self.supabase
             
-            if client is None:
-                client = create_client(str(self.supabase_url), str(self.supabase_service_key or self.supabase_anon_key))
-            
             # Serialize the data
-            serialized_data = self._serialize_for_json(update_data)
+            serialized_data = _to_json_compatible(update_data)
             
-            result = client.table("supplement_logs").update(serialized_data).eq("id", log_id).execute()
+            query = client.table("supplement_logs").update(serialized_data).eq("id", log_id)
+            if user_id is not None:
+                query = query.eq("user_id", user_id)
+            if exclude_status is not None:
+                query = query.neq("status", exclude_status)
+            result = await _execute(query)
             
             if result.data:
                 logger.info(f"Supplement log updated successfully: {log_id}")
                 return result.data[0]
+            elif user_id is not None or exclude_status is not None:
+                logger.debug("No supplement log %s matched the update filters", log_id)
+                return None
             else:
                 logger.error(f"Failed to update supplement log: {log_id}")
                 raise Exception("Failed to update supplement log")
@@ -561,27 +688,30 @@ class Database:
             raise
     
     # Chat operations
+    def get_cached_response(self, user_id: str, msg_hash: str) -> Optional[str]:
+        """Return a recent assistant reply for the same question, if any"""
+        return _chat_response_cache.get((user_id, msg_hash))
+    
+    def set_cached_response(self, user_id: str, msg_hash: str, response: str) -> None:
+        """Remember an assistant reply for repeated questions"""
+        _chat_response_cache[(user_id, msg_hash)] = response
+    
     async def save_chat_message(self, user_id: str, sender: str, message: str, context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """Save a chat message"""
         try:
-            logger.debug(f"Saving chat message for user {user_id}, sender: {sender}")
+            logger.debug("Saving chat message for user %s, sender: %s", user_id, sender)
             
             message_data = {
                 "user_id": user_id,
                 "sender": sender,
                 "message": message,
-                "context": json.dumps(context) if context else None,
-                "timestamp": datetime.utcnow().isoformat()
+                "context": _to_json_compatible(context) if context else None
             }
 
-            # Ensure Supabase client is initialized
-            if self.supabase is None:
-                self.supabase = create_client(str(self.supabase_url), str(self.supabase_anon_key))
-            
-            result = self.supabase.table("chat_messages").insert(message_data).execute()
+            result = await _execute(self.supabase.table("chat_messages").insert(message_data))
             
             if result.data:
-                logger.debug(f"Chat message saved: {result.data[0]['id']}")
+                logger.debug("Chat message saved: %s", result.data[0]['id'])
                 return result.data[0]
             else:
                 logger.error("Failed to save chat message")
@@ -591,31 +721,60 @@ class Database:
             logger.error(f"Save chat message error: {str(e)}")
             raise
     
-    async def get_chat_history(self, user_id: str, limit: int = 50) -> List[Dict[str, Any]]:
-        """Get chat history for a user"""
+    async def get_chat_history(
+        self,
+        user_id: str,
+        limit: int = 50,
+        before: Optional[str] = None,
+        cleared_at: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """Get chat history for a user, optionally only messages older than the `before` cursor.
+
+        Messages at or before `cleared_at` (the user's chat_cleared_at) are treated as deleted.
+        """
         try:
-            logger.debug(f"Getting chat history for user {user_id}, limit: {limit}")
-            
-            # Ensure Supabase client is initialized
-            if self.supabase is None:
-                self.supabase = create_client(str(self.supabase_url), str(self.supabase_anon_key))
-            
-            result = self.supabase.table("chat_messages").select("*").eq("user_id", user_id).order("timestamp", desc=True).limit(limit).execute()
-            
-            messages = result.data or []
-            # Reverse to get chronological order
-            messages.reverse()
-            
-            logger.debug(f"Found {len(messages)} chat messages for user {user_id}")
-            
-            # Parse context JSON
-            for message in messages:
-                if message.get('context') and isinstance(message['context'], str):
+            logger.debug("Getting chat history for user %s, limit: %s, before: %s", user_id, limit, before)
+            
+            # Keyset pagination served by idx_chat_messages_user_timestamp
+            if self.pool is not None:
+                conditions = ['user_id = $1']
+                args: List[Any] = [user_id]
+                if before:
+                    args.append(before)
+                    conditions.append(f'"timestamp" < ${len(args)}')
+                if cleared_at:
+                    args.append(cleared_at)
+                    conditions.append(f'"timestamp" > ${len(args)}')
+                args.append(limit)
+                records = await self.pool.fetch(
+                    f'SELECT id, user_id, sender, message, context, "timestamp" FROM chat_messages '
+                    f'WHERE {" AND ".join(conditions)} ORDER BY "timestamp" DESC LIMIT ${len(args)}',
+                    *args
+                )
+                rows = [dict(record) for record in records]
+            else:
+                query = self.supabase.table("chat_messages").select(CHAT_MESSAGE_COLUMNS).eq("user_id", user_id)
+                if before:
+                    query = query.lt("timestamp", before)
+                if cleared_at:
+                    query = query.gt("timestamp", cleared_at)
+                result = await _execute(query.order("timestamp", desc=True).limit(limit))
+                rows = result.data or []
+            logger.debug("Found %s chat messages for user %s", len(rows), user_id)
+            
+            # Walk the newest-first page backwards to get chronological order. context is jsonb
+            # (migrations/006) and arrives decoded; only a database that hasn't had that migration
+            # applied still hands back JSON text
+            messages = []
+            for message in reversed(rows):
+                context = message.get('context')
+                if context and isinstance(context, str):
                     try:
-                        message['context'] = json.loads(message['context'])
-                    except json.JSONDecodeError:
+                        message['context'] = orjson.loads(context)
+                    except orjson.JSONDecodeError:
                         logger.warning(f"Failed to parse context for message {message['id']}")
                         message['context'] = {}
+                messages.append(message)
             
             return messages
             
@@ -624,17 +783,25 @@ class Database:
             raise
     
     async def clear_chat_history(self, user_id: str) -> bool:
-        """Clear chat history for a user"""
+        """Clear chat history for a user.
+
+        This is a logical delete: the user's chat_cleared_at watermark is moved to now and
+        get_chat_history hides everything before it. The rows themselves are purged later by
+        purge_cleared_chat_messages() (see migrations/) instead of in the request.
+        """
         try:
             logger.info(f"Clearing chat history for user: {user_id}")
             
-            # Ensure Supabase client is initialized
-            if self.supabase is None:
-                self.supabase = create_client(str(self.supabase_url), str(self.supabase_anon_key))
-            result = self.supabase.table("chat_messages").delete().eq("user_id", user_id).execute()
+            # The watermark is taken from the database clock, like message timestamps (migrations/010)
+            result = await _execute(self.supabase.rpc("clear_chat_history", {"p_user_id": user_id}))
+            cleared_at = result.data
+            if cleared_at is None:
+                # No users row was updated (stale or deleted user id)
+                logger.warning(f"Clear chat history: user {user_id} not found")
+                return False
+            self.invalidate_cached_user(user_id=user_id)
             
-            deleted_count = len(result.data) if result.data else 0
-            logger.info(f"Cleared {deleted_count} chat messages for user {user_id}")
+            logger.info(f"Cleared chat history for user {user_id} at {cleared_at}")
             
             return True
             
@@ -642,11 +809,20 @@ class Database:
             logger.error(f"Clear chat history error: {str(e)}")
             raise
 
+# Shared instance: the Supabase clients (and their HTTP connection pools) are created once
+# per process instead of once per request
+_database: Optional[Database] = None
+# Held while the first caller initializes it, so concurrent first requests don't each build one
+_database_lock = asyncio.Lock()
+
 # Dependency to get database instance
 async def get_database() -> Database:
-    """Get database instance"""
-    # In a real application, you might want to use dependency injection
-    # For now, we'll create a new instance each time
-    db = Database()
-    await db.initialize()
-    return db
\ No newline at end of file
+    """Get the shared database instance, initializing it on first use"""
+    global _database
+    if _database is None:
+        async with _database_lock:
+            if _database is None:
+                db = Database()
+                await db.initialize()
+                _database = db
+    return _database
\ No newline at end of file
@@ -4,26 +4,106 @@ Handles email verification and password reset emails with real status reporting
 """
 
 import os
+import re
+import asyncio
 import logging
-import smtplib
-import secrets
-import hashlib
-from datetime import datetime, timedelta
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from typing import Optional, Dict, Any, Tuple
+import time
+import ssl
+from datetime import datetime, timezone
+from email.message import EmailMessage
+from urllib.parse import urlencode
+from typing import Optional, Dict, Any, List, Tuple
 from dotenv import load_dotenv
+import aiosmtplib
+from jinja2 import Environment, FileSystemLoader, select_autoescape
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+# Pooled SMTP connections: at most SMTP_POOL_SIZE sends run at once, each on its own
+# authenticated connection. A connection idle for longer than SMTP_IDLE_CHECK_SECONDS is probed
+# with NOOP before reuse, and one is retired after SMTP_MAX_MESSAGES_PER_CONNECTION messages
+# (providers throttle or drop long-lived sessions).
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "5"))
+SMTP_IDLE_CHECK_SECONDS = 60
+SMTP_MAX_MESSAGES_PER_CONNECTION = 100
+
+# Cheap shape check for a bare recipient address, so a malformed one is rejected before a pooled
+# connection is checked out (the server would refuse it anyway)
+_RECIPIENT_RE = re.compile(r"^[^@\s<>,;]+@[^@\s<>,;]+\.[^@\s<>,;]+$")
+
+class _IndentStrippingLoader(FileSystemLoader):
+    """Drop the source indentation of HTML templates; it is only there for readability and would
+    otherwise be sent in every message"""
+    def get_source(self, environment, template):
+        source, filename, uptodate = super().get_source(environment, template)
+        if template.endswith(".html"):
+            source = re.sub(r"\n[ \t]+", "\n", source)
+        return source, filename, uptodate
+
+# Email bodies live in templates/email and are compiled once at import; HTML templates are
+# autoescaped so user-supplied names can't inject markup
+_template_env = Environment(
+    loader=_IndentStrippingLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates", "email")),
+    autoescape=select_autoescape(["html"]),
+    auto_reload=False
+)
+_VERIFY_HTML_TEMPLATE = _template_env.get_template("verify.html")
+_VERIFY_TEXT_TEMPLATE = _template_env.get_template("verify.txt")
+_RESET_HTML_TEMPLATE = _template_env.get_template("reset.html")
+_RESET_TEXT_TEMPLATE = _template_env.get_template("reset.txt")
+
+# Transactional email kinds: subject (formatted with app_name), HTML and text templates, the
+# frontend path the emailed link points at, the template variable holding that link, and a label
+# for logs/errors
+_EMAIL_KINDS = {
+    "verify": (
+        "Welcome to {app_name} - Verify Your Email", _VERIFY_HTML_TEMPLATE, _VERIFY_TEXT_TEMPLATE,
+        "/auth/verify-email", "verification_url", "verification email"
+    ),
+    "reset": (
+        "{app_name} - Password Reset Request", _RESET_HTML_TEMPLATE, _RESET_TEXT_TEMPLATE,
+        "/auth/reset-password", "reset_url", "password reset email"
+    ),
+}
+
 class EmailDeliveryResult:
     """Result object for email delivery attempts"""
+    __slots__ = ("success", "message", "error_code", "_created")
+    
     def __init__(self, success: bool, message: str, error_code: Optional[str] = None):
         self.success = success
         self.message = message
         self.error_code = error_code
-        self.timestamp = datetime.utcnow()
+        self._created = time.time()
+    
+    @property
+    def timestamp(self) -> datetime:
+        """When the attempt finished (UTC); built on access since callers rarely read it"""
+        return datetime.fromtimestamp(self._created, timezone.utc)
+
+# How a failed send is reported, checked in order (the first matching type wins, so subclasses
+# come before their bases); message formats get error, server and port
+_SMTP_ERRORS = (
+    (aiosmtplib.SMTPAuthenticationError,
+     "SMTP authentication failed: {error}. Check your username and password.", "SMTP_AUTH_FAILED"),
+    (aiosmtplib.SMTPRecipientsRefused, "All recipients were refused: {error}", "RECIPIENTS_REFUSED"),
+    (aiosmtplib.SMTPSenderRefused, "Sender was refused: {error}", "SENDER_REFUSED"),
+    (aiosmtplib.SMTPDataError, "SMTP data error: {error}", "SMTP_DATA_ERROR"),
+    (aiosmtplib.SMTPConnectError,
+     "Failed to connect to SMTP server {server}:{port}: {error}", "SMTP_CONNECT_FAILED"),
+    (aiosmtplib.SMTPServerDisconnected, "SMTP server disconnected unexpectedly: {error}", "SMTP_DISCONNECTED"),
+    (aiosmtplib.SMTPException, "Unexpected SMTP error: {error}", "SMTP_UNEXPECTED_ERROR"),
+)
+
+class _PooledSMTP:
+    """An authenticated SMTP connection plus the bookkeeping the pool needs"""
+    __slots__ = ("smtp", "messages_sent", "last_used")
+    
+    def __init__(self, smtp: aiosmtplib.SMTP):
+        self.smtp = smtp
+        self.messages_sent = 0
+        self.last_used = time.monotonic()
 
 class EmailService:
     """Email service for sending verification and reset emails with real status reporting"""
@@ -31,15 +111,25 @@ class EmailService:
     def __init__(self):
         self.smtp_server = os.getenv("SMTP_SERVER", "smtp.gmail.com")
         self.smtp_port = int(os.getenv("SMTP_PORT", "587"))
+        # Implicit TLS (SMTPS) skips the plaintext EHLO/STARTTLS exchange on every new connection;
+        # on by default for port 465, and can be forced either way with SMTP_USE_SSL
+        self.smtp_use_ssl = os.getenv("SMTP_USE_SSL", str(self.smtp_port == 465)).lower() in ("1", "true", "yes")
         self.smtp_username = os.getenv("SMTP_USERNAME")
         self.smtp_password = os.getenv("SMTP_PASSWORD")
-        self.from_email = os.getenv("FROM_EMAIL", self.smtp_username)
+        self.from_email = os.getenv("FROM_EMAIL") or self.smtp_username or "no-reply@example.com"
         self.app_name = "SafeDoser"
         self.frontend_url = os.getenv("FRONTEND_URL", "https://safedoser.netlify.app")
         
         # Check if email is configured
         self.is_configured = bool(self.smtp_username and self.smtp_password)
         
+        # One TLS context (CA bundle loaded once) shared by every pooled connection
+        self._tls_context = ssl.create_default_context()
+        
+        # SMTP connection pool, filled lazily by sends; idle connections are reused newest-first
+        self._smtp_idle: List[_PooledSMTP] = []
+        self._smtp_slots = asyncio.Semaphore(SMTP_POOL_SIZE)
+        
         if not self.is_configured:
             logger.warning("Email service not configured. Email features will be disabled.")
     
@@ -62,126 +152,16 @@ class EmailService:
             missing.append("SMTP_PASSWORD")
         return missing
     
-    def generate_verification_token(self, email: str) -> str:
-        """Generate a secure verification token"""
-        timestamp = str(int(datetime.utcnow().timestamp()))
-        random_bytes = secrets.token_hex(16)
-        token_data = f"{email}:{timestamp}:{random_bytes}"
-        
-        # Hash the token data for security
-        token = hashlib.sha256(token_data.encode()).hexdigest()
-        return token
-    
-    def generate_reset_token(self, email: str) -> str:
-        """Generate a secure password reset token"""
-        return self.generate_verification_token(email)
-    
     async def send_verification_email(self, email: str, name: str, token: str) -> EmailDeliveryResult:
         """Send email verification email with real status reporting"""
-        if not self.is_configured:
-            return EmailDeliveryResult(
-                success=False,
-                message="Email service not configured. Please check SMTP settings.",
-                error_code="EMAIL_NOT_CONFIGURED"
-            )
-        
-        try:
-            verification_url = f"{self.frontend_url}/auth/verify-email?token={token}&email={email}"
-            
-            subject = f"Welcome to {self.app_name} - Verify Your Email"
-            
-            html_body = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="utf-8">
-                <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <title>Verify Your Email - {self.app_name}</title>
-                <style>
-                    body {{ font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; margin: 0; padding: 0; background-color: #f5f5f5; }}
-                    .container {{ max-width: 600px; margin: 0 auto; background-color: white; }}
-                    .header {{ background: linear-gradient(135deg, #08B5A6, #066B65); padding: 40px 30px; text-align: center; }}
-                    .header h1 {{ color: white; margin: 0; font-size: 28px; font-weight: bold; }}
-                    .content {{ padding: 40px 30px; }}
-                    .welcome {{ font-size: 24px; color: #121417; margin-bottom: 20px; font-weight: 600; }}
-                    .message {{ font-size: 16px; color: #6b7280; line-height: 1.6; margin-bottom: 30px; }}
-                    .button {{ display: inline-block; background: linear-gradient(135deg, #08B5A6, #066B65); color: white; padding: 16px 32px; text-decoration: none; border-radius: 12px; font-weight: 600; font-size: 16px; margin: 20px 0; }}
-                    .button:hover {{ background: linear-gradient(135deg, #066B65, #044A46); }}
-                    .footer {{ background-color: #f8f9fa; padding: 30px; text-align: center; border-top: 1px solid #e9ecef; }}
-                    .footer p {{ color: #6b7280; font-size: 14px; margin: 5px 0; }}
-                    .security-note {{ background-color: #dbf5f2; border-left: 4px solid #08B5A6; padding: 15px; margin: 20px 0; border-radius: 4px; }}
-                    .security-note p {{ color: #066B65; font-size: 14px; margin: 0; }}
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <div class="header">
-                        <h1>💊 {self.app_name}</h1>
-                    </div>
-                    <div class="content">
-                        <h2 class="welcome">Welcome to {self.app_name}, {name}! 🎉</h2>
-                        <p class="message">
-                            Thank you for signing up for {self.app_name}, your personal medication companion. 
-                            To get started and secure your account, please verify your email address by clicking the button below.
-                        </p>
-                        <div style="text-align: center;">
-                            <a href="{verification_url}" class="button">Verify My Email Address</a>
-                        </div>
-                        <div class="security-note">
-                            <p><strong>🔒 Security Note:</strong> This verification link will expire in 24 hours for your security. If you didn't create an account with {self.app_name}, please ignore this email.</p>
-                        </div>
-                        <p class="message">
-                            Once verified, you'll be able to:
-                            <br>• 📋 Track your medications and supplements
-                            <br>• ⏰ Set up smart reminders
-                            <br>• 🤖 Chat with our AI health assistant
-                            <br>• 📊 Monitor your medication adherence
-                        </p>
-                        <p class="message">
-                            If the button doesn't work, you can copy and paste this link into your browser:
-                            <br><a href="{verification_url}" style="color: #08B5A6; word-break: break-all;">{verification_url}</a>
-                        </p>
-                    </div>
-                    <div class="footer">
-                        <p><strong>{self.app_name}</strong> - Your Personal Medication Companion</p>
-                        <p>This email was sent to {email}</p>
-                        <p>If you have any questions, please contact our support team.</p>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
-            
-            text_body = f"""
-            Welcome to {self.app_name}, {name}!
-            
-            Thank you for signing up for {self.app_name}, your personal medication companion.
-            
-            To get started and secure your account, please verify your email address by visiting this link:
-            {verification_url}
-            
-            This verification link will expire in 24 hours for your security.
-            
-            Once verified, you'll be able to track your medications, set up reminders, and chat with our AI health assistant.
-            
-            If you didn't create an account with {self.app_name}, please ignore this email.
-            
-            Best regards,
-            The {self.app_name} Team
-            """
-            
-            return await self._send_email(email, subject, text_body, html_body)
-            
-        except Exception as e:
-            logger.error(f"Failed to send verification email to {email}: {str(e)}")
-            return EmailDeliveryResult(
-                success=False,
-                message=f"Failed to send verification email: {str(e)}",
-                error_code="EMAIL_SEND_FAILED"
-            )
+        return await self._send_templated("verify", email, name, token)
     
     async def send_password_reset_email(self, email: str, name: str, token: str) -> EmailDeliveryResult:
         """Send password reset email with real status reporting"""
+        return await self._send_templated("reset", email, name, token)
+    
+    async def _send_templated(self, kind: str, email: str, name: str, token: str) -> EmailDeliveryResult:
+        """Render one of the _EMAIL_KINDS for a recipient and send it"""
         if not self.is_configured:
             return EmailDeliveryResult(
                 success=False,
@@ -189,208 +169,150 @@ class EmailService:
                 error_code="EMAIL_NOT_CONFIGURED"
             )
         
+        subject_format, html_template, text_template, url_path, url_var, label = _EMAIL_KINDS[kind]
         try:
-            reset_url = f"{self.frontend_url}/auth/reset-password?token={token}&email={email}"
-            
-            subject = f"{self.app_name} - Password Reset Request"
-            
-            html_body = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="utf-8">
-                <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <title>Password Reset - {self.app_name}</title>
-                <style>
-                    body {{ font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; margin: 0; padding: 0; background-color: #f5f5f5; }}
-                    .container {{ max-width: 600px; margin: 0 auto; background-color: white; }}
-                    .header {{ background: linear-gradient(135deg, #08B5A6, #066B65); padding: 40px 30px; text-align: center; }}
-                    .header h1 {{ color: white; margin: 0; font-size: 28px; font-weight: bold; }}
-                    .content {{ padding: 40px 30px; }}
-                    .title {{ font-size: 24px; color: #121417; margin-bottom: 20px; font-weight: 600; }}
-                    .message {{ font-size: 16px; color: #6b7280; line-height: 1.6; margin-bottom: 30px; }}
-                    .button {{ display: inline-block; background: linear-gradient(135deg, #08B5A6, #066B65); color: white; padding: 16px 32px; text-decoration: none; border-radius: 12px; font-weight: 600; font-size: 16px; margin: 20px 0; }}
-                    .button:hover {{ background: linear-gradient(135deg, #066B65, #044A46); }}
-                    .footer {{ background-color: #f8f9fa; padding: 30px; text-align: center; border-top: 1px solid #e9ecef; }}
-                    .footer p {{ color: #6b7280; font-size: 14px; margin: 5px 0; }}
-                    .security-note {{ background-color: #fff3cd; border-left: 4px solid #ffc107; padding: 15px; margin: 20px 0; border-radius: 4px; }}
-                    .security-note p {{ color: #856404; font-size: 14px; margin: 0; }}
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <div class="header">
-                        <h1>💊 {self.app_name}</h1>
-                    </div>
-                    <div class="content">
-                        <h2 class="title">Password Reset Request 🔐</h2>
-                        <p class="message">
-                            Hi {name},
-                            <br><br>
-                            We received a request to reset the password for your {self.app_name} account. 
-                            If you made this request, click the button below to reset your password.
-                        </p>
-                        <div style="text-align: center;">
-                            <a href="{reset_url}" class="button">Reset My Password</a>
-                        </div>
-                        <div class="security-note">
-                            <p><strong>⚠️ Security Notice:</strong> This password reset link will expire in 1 hour for your security. If you didn't request a password reset, please ignore this email and your password will remain unchanged.</p>
-                        </div>
-                        <p class="message">
-                            If the button doesn't work, you can copy and paste this link into your browser:
-                            <br><a href="{reset_url}" style="color: #08B5A6; word-break: break-all;">{reset_url}</a>
-                        </p>
-                        <p class="message">
-                            For your security, this link will only work once and expires in 1 hour.
-                        </p>
-                    </div>
-                    <div class="footer">
-                        <p><strong>{self.app_name}</strong> - Your Personal Medication Companion</p>
-                        <p>This email was sent to {email}</p>
-                        <p>If you have any questions, please contact our support team.</p>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
-            
-            text_body = f"""
-            Password Reset Request - {self.app_name}
-            
-            Hi {name},
-            
-            We received a request to reset the password for your {self.app_name} account.
-            
-            If you made this request, visit this link to reset your password:
-            {reset_url}
-            
-            This password reset link will expire in 1 hour for your security.
-            
-            If you didn't request a password reset, please ignore this email and your password will remain unchanged.
-            
-            Best regards,
-            The {self.app_name} Team
-            """
+            template_vars = {
+                "app_name": self.app_name,
+                "name": name,
+                "email": email,
+                # urlencode so addresses with "+" (or other reserved characters) survive the link
+                url_var: f"{self.frontend_url}{url_path}?{urlencode({'token': token, 'email': email})}"
+            }
+            subject = subject_format.format(app_name=self.app_name)
+            html_body = html_template.render(template_vars)
+            text_body = text_template.render(template_vars)
             
             return await self._send_email(email, subject, text_body, html_body)
             
         except Exception as e:
-            logger.error(f"Failed to send password reset email to {email}: {str(e)}")
+            logger.error(f"Failed to send {label} to {email}: {str(e)}")
             return EmailDeliveryResult(
                 success=False,
-                message=f"Failed to send password reset email: {str(e)}",
+                message=f"Failed to send {label}: {str(e)}",
                 error_code="EMAIL_SEND_FAILED"
             )
     
+    async def _connect_smtp(self) -> aiosmtplib.SMTP:
+        """Open and authenticate a new SMTP connection (implicit TLS or STARTTLS, see smtp_use_ssl)"""
+        smtp = aiosmtplib.SMTP(
+            hostname=self.smtp_server,
+            port=self.smtp_port,
+            username=self.smtp_username,
+            password=self.smtp_password,
+            use_tls=self.smtp_use_ssl,
+            start_tls=not self.smtp_use_ssl,
+            tls_context=self._tls_context
+        )
+        await smtp.connect()
+        return smtp
+    
+    async def _acquire_smtp(self) -> _PooledSMTP:
+        """Check a connection out of the pool, opening one if no usable idle connection is left"""
+        await self._smtp_slots.acquire()
+        try:
+            while self._smtp_idle:
+                conn = self._smtp_idle.pop()
+                if not conn.smtp.is_connected:
+                    continue
+                if time.monotonic() - conn.last_used < SMTP_IDLE_CHECK_SECONDS:
+                    return conn
+                try:
+                    # Servers drop idle sessions; a NOOP tells us whether this one is still usable
+                    await conn.smtp.noop()
+                    return conn
+                except aiosmtplib.SMTPException:
+                    logger.debug("Idle SMTP connection is gone, discarding it")
+                    await self._quit_smtp(conn.smtp)
+            return _PooledSMTP(await self._connect_smtp())
+        except BaseException:
+            self._smtp_slots.release()
+            raise
+    
+    async def _release_smtp(self, conn: _PooledSMTP, reusable: bool) -> None:
+        """Return a connection to the pool, or close it if it failed or has done its share"""
+        try:
+            conn.last_used = time.monotonic()
+            if reusable and conn.smtp.is_connected and conn.messages_sent < SMTP_MAX_MESSAGES_PER_CONNECTION:
+                self._smtp_idle.append(conn)
+            else:
+                await self._quit_smtp(conn.smtp)
+        finally:
+            self._smtp_slots.release()
+    
+    @staticmethod
+    async def _quit_smtp(smtp: aiosmtplib.SMTP) -> None:
+        """Close an SMTP connection politely, falling back to dropping the socket"""
+        if smtp.is_connected:
+            try:
+                await smtp.quit()
+            except aiosmtplib.SMTPException:
+                smtp.close()
+    
+    async def close(self) -> None:
+        """Close the idle pooled SMTP connections"""
+        idle, self._smtp_idle = self._smtp_idle, []
+        for conn in idle:
+            await self._quit_smtp(conn.smtp)
+    
     async def _send_email(self, to_email: str, subject: str, text_body: str, html_body: str) -> EmailDeliveryResult:
-        """Send email using SMTP with detailed error reporting"""
+        """Send email over a pooled SMTP connection with detailed error reporting.
+
+        Callers check is_configured first, so credentials are known to be set here.
+        """
         try:
-            # Validate email configuration
-            if not self.smtp_username or not self.smtp_password:
+            if not _RECIPIENT_RE.match(to_email):
                 return EmailDeliveryResult(
                     success=False,
-                    message="SMTP credentials not configured",
-                    error_code="SMTP_CREDENTIALS_MISSING"
+                    message=f"Invalid recipient address: {to_email}",
+                    error_code="INVALID_RECIPIENT"
                 )
             
-            # Create message
-            msg = MIMEMultipart('alternative')
+            # Create message: plain text with an HTML alternative (multipart/alternative)
+            msg = EmailMessage()
             msg['Subject'] = subject
-            msg['From'] = self.from_email if self.from_email is not None else "no-reply@example.com"
+            msg['From'] = self.from_email
             msg['To'] = to_email
+            msg.set_content(text_body)
+            msg.add_alternative(html_body, subtype='html')
             
-            # Add text and HTML parts
-            text_part = MIMEText(text_body, 'plain')
-            html_part = MIMEText(html_body, 'html')
-            
-            msg.attach(text_part)
-            msg.attach(html_part)
-            
-            # Send email with detailed error handling
+            # Send over a pooled connection (TLS + AUTH done once per connection); a connection
+            # that raised is closed rather than pooled
+            conn = await self._acquire_smtp()
+            reusable = False
             try:
-                with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                    # Enable debug output for troubleshooting
-                    server.set_debuglevel(0)
-                    
-                    # Start TLS encryption
-                    try:
-                        server.starttls()
-                    except smtplib.SMTPException as e:
-                        return EmailDeliveryResult(
-                            success=False,
-                            message=f"Failed to start TLS encryption: {str(e)}",
-                            error_code="SMTP_TLS_FAILED"
-                        )
-                    
-                    # Authenticate
-                    try:
-                        server.login(self.smtp_username, self.smtp_password)
-                    except smtplib.SMTPAuthenticationError as e:
-                        return EmailDeliveryResult(
-                            success=False,
-                            message=f"SMTP authentication failed: {str(e)}. Check your username and password.",
-                            error_code="SMTP_AUTH_FAILED"
-                        )
-                    except smtplib.SMTPException as e:
-                        return EmailDeliveryResult(
-                            success=False,
-                            message=f"SMTP login error: {str(e)}",
-                            error_code="SMTP_LOGIN_ERROR"
-                        )
-                    
-                    # Send the email
-                    try:
-                        refused = server.send_message(msg)
-                        if refused:
-                            return EmailDeliveryResult(
-                                success=False,
-                                message=f"Email was refused by some recipients: {refused}",
-                                error_code="EMAIL_REFUSED"
-                            )
-                        else:
-                            logger.info(f"Email sent successfully to {to_email}")
-                            return EmailDeliveryResult(
-                                success=True,
-                                message=f"Email sent successfully to {to_email}"
-                            )
-                    except smtplib.SMTPRecipientsRefused as e:
-                        return EmailDeliveryResult(
-                            success=False,
-                            message=f"All recipients were refused: {str(e)}",
-                            error_code="RECIPIENTS_REFUSED"
-                        )
-                    except smtplib.SMTPSenderRefused as e:
-                        return EmailDeliveryResult(
-                            success=False,
-                            message=f"Sender was refused: {str(e)}",
-                            error_code="SENDER_REFUSED"
-                        )
-                    except smtplib.SMTPDataError as e:
-                        return EmailDeliveryResult(
-                            success=False,
-                            message=f"SMTP data error: {str(e)}",
-                            error_code="SMTP_DATA_ERROR"
-                        )
-                        
-            except smtplib.SMTPConnectError as e:
-                return EmailDeliveryResult(
-                    success=False,
-                    message=f"Failed to connect to SMTP server {self.smtp_server}:{self.smtp_port}: {str(e)}",
-                    error_code="SMTP_CONNECT_FAILED"
-                )
-            except smtplib.SMTPServerDisconnected as e:
-                return EmailDeliveryResult(
-                    success=False,
-                    message=f"SMTP server disconnected unexpectedly: {str(e)}",
-                    error_code="SMTP_DISCONNECTED"
-                )
-            except Exception as e:
+                try:
+                    refused, _ = await conn.smtp.send_message(msg)
+                except aiosmtplib.SMTPServerDisconnected:
+                    # The server closed the session between our check and the send: retry once
+                    await self._quit_smtp(conn.smtp)
+                    conn = _PooledSMTP(await self._connect_smtp())
+                    refused, _ = await conn.smtp.send_message(msg)
+                conn.messages_sent += 1
+                reusable = True
+            finally:
+                await self._release_smtp(conn, reusable)
+            
+            if refused:
                 return EmailDeliveryResult(
                     success=False,
-                    message=f"Unexpected SMTP error: {str(e)}",
-                    error_code="SMTP_UNEXPECTED_ERROR"
+                    message=f"Email was refused by some recipients: {refused}",
+                    error_code="EMAIL_REFUSED"
                 )
-                
+            logger.info(f"Email sent successfully to {to_email}")
+            return EmailDeliveryResult(
+                success=True,
+                message=f"Email sent successfully to {to_email}"
+            )
+            
+        except aiosmtplib.SMTPException as e:
+            message_format, error_code = next(
+                (fmt, code) for error_type, fmt, code in _SMTP_ERRORS if isinstance(e, error_type)
+            )
+            return EmailDeliveryResult(
+                success=False,
+                message=message_format.format(error=e, server=self.smtp_server, port=self.smtp_port),
+                error_code=error_code
+            )
         except Exception as e:
             logger.error(f"Failed to send email to {to_email}: {str(e)}")
             return EmailDeliveryResult(
@@ -399,8 +321,9 @@ class EmailService:
                 error_code="EMAIL_SERVICE_ERROR"
             )
     
-    def test_smtp_connection(self) -> EmailDeliveryResult:
-        """Test SMTP connection and authentication"""
+    async def test_smtp_connection(self) -> EmailDeliveryResult:
+        """Test SMTP connection and authentication through the pool (reusing a live idle
+        connection if there is one), so the tested connection warms it"""
         if not self.is_configured:
             return EmailDeliveryResult(
                 success=False,
@@ -409,29 +332,21 @@ class EmailService:
             )
         
         try:
-            with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                server.set_debuglevel(0)
-                server.starttls()
-                if self.smtp_username is None or self.smtp_password is None:
-                    return EmailDeliveryResult(
-                        success=False,
-                        message="SMTP credentials not configured",
-                        error_code="SMTP_CREDENTIALS_MISSING"
-                    )
-                server.login(self.smtp_username, self.smtp_password)
-                
-                return EmailDeliveryResult(
-                    success=True,
-                    message="SMTP connection and authentication successful"
-                )
+            conn = await self._acquire_smtp()
+            await self._release_smtp(conn, reusable=True)
+            
+            return EmailDeliveryResult(
+                success=True,
+                message="SMTP connection and authentication successful"
+            )
                 
-        except smtplib.SMTPAuthenticationError as e:
+        except aiosmtplib.SMTPAuthenticationError as e:
             return EmailDeliveryResult(
                 success=False,
                 message=f"SMTP authentication failed: {str(e)}",
                 error_code="SMTP_AUTH_FAILED"
             )
-        except smtplib.SMTPConnectError as e:
+        except aiosmtplib.SMTPConnectError as e:
             return EmailDeliveryResult(
                 success=False,
                 message=f"Failed to connect to SMTP server: {str(e)}",
@@ -0,0 +1,15 @@
+-- SafeDoser: indexes for chat history pagination and supplement log lookups
+--
+-- CREATE INDEX CONCURRENTLY cannot run inside a transaction block, so run
+-- each statement on its own in the Supabase SQL editor.
+
+-- Serves get_chat_history: WHERE user_id = $1 [AND timestamp < $cursor]
+-- ORDER BY timestamp DESC LIMIT $n as a bounded index scan instead of a sort
+-- over the user's whole history.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_chat_messages_user_timestamp
+    ON chat_messages (user_id, timestamp DESC);
+
+-- Serves get_supplement_log_by_supplement_and_time, which looks up today's
+-- log for a (user, supplement, scheduled time) slot.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_supplement_logs_user_supplement_time
+    ON supplement_logs (user_id, supplement_id, scheduled_time, created_at);
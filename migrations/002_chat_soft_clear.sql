@@ -0,0 +1,35 @@
+-- SafeDoser: logical "clear chat history"
+--
+-- /chat/clear no longer deletes the user's chat_messages rows in the request.
+-- It moves users.chat_cleared_at forward and reads only return messages newer
+-- than that watermark. The hidden rows are reclaimed in the background by
+-- purge_cleared_chat_messages(), e.g. from pg_cron:
+--
+--   SELECT cron.schedule('purge-cleared-chat', '*/15 * * * *',
+--                        'SELECT purge_cleared_chat_messages()');
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS chat_cleared_at timestamptz;
+
+CREATE OR REPLACE FUNCTION purge_cleared_chat_messages(batch_size integer DEFAULT 5000)
+RETURNS integer
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    purged integer;
+BEGIN
+    -- Bounded batches keep each run's WAL and lock footprint small.
+    WITH doomed AS (
+        SELECT m.id
+        FROM chat_messages m
+        JOIN users u ON u.id = m.user_id
+        WHERE u.chat_cleared_at IS NOT NULL
+          AND m.timestamp <= u.chat_cleared_at
+        LIMIT batch_size
+    )
+    DELETE FROM chat_messages
+    WHERE id IN (SELECT id FROM doomed);
+
+    GET DIAGNOSTICS purged = ROW_COUNT;
+    RETURN purged;
+END;
+$$;
@@ -0,0 +1,24 @@
+-- SafeDoser: store supplement JSON fields as jsonb
+--
+-- times_of_day and interactions used to be written as JSON text, so every read
+-- had to json-decode them again in Python. As jsonb, PostgREST (and asyncpg)
+-- hand them back as objects/arrays and the API writes dicts/lists directly.
+--
+-- The ::text::jsonb cast handles text columns; the UPDATEs then unwrap values
+-- that an older jsonb column held as a JSON *string* of the document.
+
+ALTER TABLE supplements
+    ALTER COLUMN times_of_day TYPE jsonb USING times_of_day::text::jsonb,
+    ALTER COLUMN interactions TYPE jsonb USING interactions::text::jsonb;
+
+UPDATE supplements
+SET times_of_day = (times_of_day #>> '{}')::jsonb
+WHERE jsonb_typeof(times_of_day) = 'string';
+
+UPDATE supplements
+SET interactions = (interactions #>> '{}')::jsonb
+WHERE jsonb_typeof(interactions) = 'string';
+
+ALTER TABLE supplements
+    ALTER COLUMN times_of_day SET DEFAULT '{}'::jsonb,
+    ALTER COLUMN interactions SET DEFAULT '[]'::jsonb;
@@ -0,0 +1,55 @@
+-- SafeDoser: server-side created_at/updated_at
+--
+-- The API no longer sends created_at/updated_at (or chat_messages.timestamp)
+-- with its writes. Postgres fills them from now() and a BEFORE UPDATE trigger
+-- bumps updated_at, so every row is stamped by the same clock.
+
+CREATE OR REPLACE FUNCTION set_updated_at()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    NEW.updated_at = now();
+    RETURN NEW;
+END;
+$$;
+
+ALTER TABLE users
+    ALTER COLUMN created_at SET DEFAULT now(),
+    ALTER COLUMN updated_at SET DEFAULT now();
+
+ALTER TABLE supplements
+    ALTER COLUMN created_at SET DEFAULT now(),
+    ALTER COLUMN updated_at SET DEFAULT now();
+
+ALTER TABLE supplement_logs
+    ALTER COLUMN created_at SET DEFAULT now();
+
+ALTER TABLE chat_messages
+    ALTER COLUMN "timestamp" SET DEFAULT now();
+
+DROP TRIGGER IF EXISTS users_set_updated_at ON users;
+CREATE TRIGGER users_set_updated_at
+    BEFORE UPDATE ON users
+    FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+
+DROP TRIGGER IF EXISTS supplements_set_updated_at ON supplements;
+CREATE TRIGGER supplements_set_updated_at
+    BEFORE UPDATE ON supplements
+    FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+
+-- supplement_logs only gets the trigger where the column exists
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = 'supplement_logs' AND column_name = 'updated_at'
+    ) THEN
+        ALTER TABLE supplement_logs ALTER COLUMN updated_at SET DEFAULT now();
+        DROP TRIGGER IF EXISTS supplement_logs_set_updated_at ON supplement_logs;
+        CREATE TRIGGER supplement_logs_set_updated_at
+            BEFORE UPDATE ON supplement_logs
+            FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+    END IF;
+END;
+$$;
@@ -0,0 +1,11 @@
+-- SafeDoser: index for per-day supplement log reads
+--
+-- CREATE INDEX CONCURRENTLY cannot run inside a transaction block, so run
+-- the statement on its own in the Supabase SQL editor.
+
+-- Serves get_supplement_logs_by_date: WHERE user_id = $1 AND created_at >= $day
+-- AND created_at < $next_day ORDER BY created_at as an index range scan. The
+-- (user_id, supplement_id, scheduled_time, created_at) index from 001 only
+-- narrows this query down to the user.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_supplement_logs_user_created_at
+    ON supplement_logs (user_id, created_at);
@@ -0,0 +1,15 @@
+-- SafeDoser: store chat message context as jsonb
+--
+-- context used to be written as a JSON string, so PostgREST shipped it back
+-- escaped and get_chat_history json-decoded it again for every message. As
+-- jsonb it is written and read as an object.
+--
+-- The ::text::jsonb cast handles a text column; the UPDATE then unwraps values
+-- that an older jsonb column held as a JSON *string* of the document.
+
+ALTER TABLE chat_messages
+    ALTER COLUMN context TYPE jsonb USING context::text::jsonb;
+
+UPDATE chat_messages
+SET context = (context #>> '{}')::jsonb
+WHERE jsonb_typeof(context) = 'string';
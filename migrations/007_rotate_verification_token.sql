@@ -0,0 +1,29 @@
+-- SafeDoser: issue a verification/reset token in one round trip
+--
+-- TokenService used to invalidate a user's outstanding tokens of a type with
+-- one PostgREST UPDATE and then insert the new token with a second request.
+-- rotate_verification_token() does both in a single transaction, so there is
+-- also no window in which the user has no valid token.
+
+CREATE OR REPLACE FUNCTION rotate_verification_token(
+    p_email text,
+    p_token text,
+    p_token_type text,
+    p_ttl interval
+)
+RETURNS boolean
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    UPDATE verification_tokens
+    SET used = true, used_at = now()
+    WHERE email = p_email
+      AND token_type = p_token_type
+      AND used = false;
+
+    INSERT INTO verification_tokens (email, token, token_type, expires_at, used, created_at)
+    VALUES (p_email, p_token, p_token_type, now() + p_ttl, false, now());
+
+    RETURN true;
+END;
+$$;
@@ -0,0 +1,18 @@
+-- SafeDoser: indexes for verification/reset token lookups
+--
+-- CREATE INDEX CONCURRENTLY cannot run inside a transaction block, so run
+-- each statement on its own in the Supabase SQL editor.
+
+-- Serves every live-token query: verify_token's consuming UPDATE,
+-- has_valid_verification_token and the invalidation step of
+-- rotate_verification_token() all filter on email, token_type and
+-- used = false (plus expires_at). Consumed tokens are most of the table, so
+-- the partial index only holds the handful of outstanding ones.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_verification_tokens_active
+    ON verification_tokens (email, token_type, expires_at)
+    WHERE used = false;
+
+-- Serves cleanup_expired_tokens: DELETE ... WHERE expires_at < now(), which
+-- removes used and unused tokens alike.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_verification_tokens_expires_at
+    ON verification_tokens (expires_at);
@@ -0,0 +1,31 @@
+-- SafeDoser: batched cleanup of expired verification/reset tokens
+--
+-- A single unbounded DELETE of every expired token holds its locks and WAL
+-- for as long as the backlog is large and can outlive the PostgREST request
+-- timeout. purge_expired_verification_tokens() removes at most batch_size
+-- rows per call; migration 011 schedules it with pg_cron.
+--
+-- TokenService.cleanup_expired_tokens() calls it in a loop until a batch
+-- comes back short.
+
+CREATE OR REPLACE FUNCTION purge_expired_verification_tokens(batch_size integer DEFAULT 1000)
+RETURNS integer
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    purged integer;
+BEGIN
+    -- Walks idx_verification_tokens_expires_at (migration 008).
+    WITH doomed AS (
+        SELECT id
+        FROM verification_tokens
+        WHERE expires_at < now()
+        LIMIT batch_size
+    )
+    DELETE FROM verification_tokens
+    WHERE id IN (SELECT id FROM doomed);
+
+    GET DIAGNOSTICS purged = ROW_COUNT;
+    RETURN purged;
+END;
+$$;
@@ -0,0 +1,18 @@
+-- SafeDoser: set the chat-clear watermark from the database clock
+--
+-- chat_messages.timestamp defaults to now() (migration 004), so the
+-- chat_cleared_at watermark compared against it must come from the same clock.
+-- Taking it from the app server would let clock skew hide new messages or
+-- bring cleared ones back. /chat/clear calls this instead of writing the
+-- timestamp itself; the rows are still reclaimed by
+-- purge_cleared_chat_messages() (migration 002).
+
+CREATE OR REPLACE FUNCTION clear_chat_history(p_user_id uuid)
+RETURNS timestamptz
+LANGUAGE sql
+AS $$
+    UPDATE users
+    SET chat_cleared_at = now()
+    WHERE id = p_user_id
+    RETURNING chat_cleared_at;
+$$;
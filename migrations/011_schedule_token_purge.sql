@@ -0,0 +1,17 @@
+-- SafeDoser: purge expired verification/reset tokens on a schedule
+--
+-- purge_expired_verification_tokens() (migration 009) only runs when
+-- something calls it. The API runs one sweep at startup, but serverless
+-- instances start and stop unpredictably, so pg_cron does the regular
+-- sweep every 10 minutes. Enable pg_cron under Database > Extensions in
+-- Supabase first (or let the CREATE EXTENSION below do it).
+
+CREATE EXTENSION IF NOT EXISTS pg_cron;
+
+-- cron.schedule() replaces an existing job with the same name, so this is
+-- safe to re-run.
+SELECT cron.schedule(
+    'purge-expired-tokens',
+    '*/10 * * * *',
+    'SELECT purge_expired_verification_tokens()'
+);
@@ -1,9 +1,26 @@
 from datetime import datetime, date
-from typing import Optional, List, Dict, Any
-from pydantic import BaseModel, EmailStr, Field, field_validator
+from typing import Optional, List, Dict, Any, Literal
+from pydantic import BaseModel, ConfigDict, EmailStr, Field, field_validator
 import re
 import base64
 
+# 24-hour HH:MM, as used for supplement scheduled times
+_TIME_RE = re.compile(r"^([01]\d|2[0-3]):[0-5]\d$")
+
+def _validate_time_format(cls, v: str) -> str:
+    """Validate time format (HH:MM); shared by the scheduled_time validators"""
+    if not _TIME_RE.match(v):
+        raise ValueError("Time must be in HH:MM format")
+    return v
+
+# Supplement log statuses; validated as literal choices (a set lookup) rather than a regex
+LogStatus = Literal["pending", "taken", "missed", "skipped"]
+MarkedStatus = Literal["taken", "missed", "skipped"]
+
+# Response models are only built from server-side data; their validation schema is compiled on
+# first use rather than at import
+RESPONSE_MODEL_CONFIG = ConfigDict(defer_build=True)
+
 # Base models
 class TimestampMixin(BaseModel):
     """Mixin for models with timestamps"""
@@ -18,24 +35,24 @@ class UserBase(BaseModel):
     age: int = Field(..., ge=13, le=120)
 
 def validate_base64_image(v: Optional[str]) -> Optional[str]:
-    """Validate base64 encoded image"""
+    """Validate base64 encoded image (a data URL or raw base64)"""
     if v is None:
         return v
-    # Check if it's a data URL
-    if v.startswith("data:image/"):
-        try:
-            header, data = v.split(",", 1)
-            base64.b64decode(data)
-            return v
-        except Exception:
-            raise ValueError("Invalid base64 image data")
-    else:
-        # Assume raw base64
-        try:
-            base64.b64decode(v)
-            return v
-        except Exception:
-            raise ValueError("Invalid base64 image data")
+    # For a data URL only the part after the comma is base64; slicing it off avoids splitting
+    # out the header
+    data = v[v.find(",") + 1:] if v.startswith("data:image/") else v
+    # Clients often send line-wrapped base64 (MIME style); drop the whitespace, which
+    # validate=True would otherwise reject
+    data = "".join(data.split())
+    # Padded base64 always comes in 4-character groups, which rejects truncated data without
+    # decoding; validate=True then checks the alphabet in the same C pass as the decode
+    if len(data) % 4:
+        raise ValueError("Invalid base64 image data")
+    try:
+        base64.b64decode(data, validate=True)
+    except ValueError:
+        raise ValueError("Invalid base64 image data")
+    return v
 
 class UserCreate(UserBase):
     """User creation model"""
@@ -73,6 +90,7 @@ class UserInDB(UserBase, TimestampMixin):
 
 class UserResponse(BaseModel):
     """User response model"""
+    model_config = RESPONSE_MODEL_CONFIG
     user: Dict[str, Any]
     access_token: str
     refresh_token: str
@@ -133,6 +151,7 @@ class SupplementInDB(SupplementBase, TimestampMixin):
 
 class SupplementResponse(BaseModel):
     """Supplement response model"""
+    model_config = RESPONSE_MODEL_CONFIG
     id: int
     user_id: str
     name: str
@@ -166,27 +185,24 @@ class ChatMessageInDB(BaseModel):
 
 class ChatResponse(BaseModel):
     """Chat response model"""
+    model_config = RESPONSE_MODEL_CONFIG
     reply: str
 
 class ChatHistoryResponse(BaseModel):
     """Chat history response model"""
+    model_config = RESPONSE_MODEL_CONFIG
     messages: List[Dict[str, Any]]
+    next_cursor: Optional[str] = None
 
 # Supplement log models
 class SupplementLogBase(BaseModel):
     """Base supplement log model"""
     supplement_id: int
     scheduled_time: str  # Time in HH:MM format
-    status: str = Field(default="pending", pattern="^(pending|taken|missed|skipped)$")
+    status: LogStatus = "pending"
     notes: Optional[str] = None
 
-    @field_validator("scheduled_time")
-    @classmethod
-    def validate_time_format(cls, v: str) -> str:
-        """Validate time format (HH:MM)"""
-        if not re.match(r"^([01]\d|2[0-3]):[0-5]\d$", v):
-            raise ValueError("Time must be in HH:MM format")
-        return v
+    validate_time_format = field_validator("scheduled_time")(_validate_time_format)
 
 class SupplementLogCreate(SupplementLogBase):
     """Supplement log creation model"""
@@ -194,7 +210,7 @@ class SupplementLogCreate(SupplementLogBase):
 
 class SupplementLogUpdate(BaseModel):
     """Supplement log update model"""
-    status: Optional[str] = Field(None, pattern="^(pending|taken|missed|skipped)$")
+    status: Optional[LogStatus] = None
     taken_at: Optional[datetime] = None
     notes: Optional[str] = None
 
@@ -206,6 +222,7 @@ class SupplementLogInDB(SupplementLogBase, TimestampMixin):
 
 class SupplementLogResponse(BaseModel):
     """Supplement log response model"""
+    model_config = RESPONSE_MODEL_CONFIG
     id: str
     user_id: str
     supplement_id: int
@@ -220,16 +237,10 @@ class MarkCompletedRequest(BaseModel):
     """Request model for marking supplement as completed"""
     supplement_id: int
     scheduled_time: str
-    status: str = Field(pattern="^(taken|missed|skipped)$")
+    status: MarkedStatus
     notes: Optional[str] = None
 
-    @field_validator("scheduled_time")
-    @classmethod
-    def validate_time_format(cls, v: str) -> str:
-        """Validate time format (HH:MM)"""
-        if not re.match(r"^([01]\d|2[0-3]):[0-5]\d$", v):
-            raise ValueError("Time must be in HH:MM format")
-        return v
+    validate_time_format = field_validator("scheduled_time")(_validate_time_format)
 
 # Health check model
 class HealthResponse(BaseModel):
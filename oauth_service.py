@@ -4,17 +4,16 @@ Handles Google OAuth authentication flows
 """
 
 import os
+import time
+import base64
 import logging
 import secrets
-import hashlib
-from datetime import datetime, timedelta
 from typing import Optional, Dict, Any
-from urllib.parse import urlencode, parse_qs
-import json
+from urllib.parse import urlencode
 
-import requests
-from authlib.integrations.requests_client import OAuth2Session
-from authlib.jose import jwt
+import httpx
+import orjson
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
 from database import Database
@@ -23,6 +22,11 @@ from auth import AuthService
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+# How long a login started at /auth/google may take to come back to the callback
+OAUTH_STATE_TTL_SECONDS = 600
+
+GOOGLE_ID_TOKEN_ISSUERS = ("https://accounts.google.com", "accounts.google.com")
+
 class OAuthService:
     """OAuth service for handling Google authentication"""
     
@@ -51,12 +55,35 @@ class OAuthService:
         # OAuth scopes
         self.google_scopes = ["openid", "email", "profile"]
         
-        # Initialize state storage
-        self._oauth_states = {}
+        # Authorization URL parameters that don't change between requests; only state is added per call
+        self._google_auth_params = {
+            "client_id": self.google_client_id,
+            "redirect_uri": self.google_redirect_uri,
+            "scope": " ".join(self.google_scopes),
+            "response_type": "code",
+            "access_type": "offline",
+            "prompt": "consent"
+        }
+        
+        # Shared async HTTP client: the token exchange and userinfo calls (and later callbacks)
+        # reuse kept-alive TLS connections to Google and don't block the event loop
+        self._client = httpx.AsyncClient(
+            headers={"User-Agent": "SafeDoser/1.0"},
+            timeout=30.0,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=40)
+        )
+        
+        # Initialize state storage: pending states expire on their own, so abandoned logins don't
+        # accumulate
+        self._oauth_states: TTLCache = TTLCache(maxsize=10000, ttl=OAUTH_STATE_TTL_SECONDS)
         
         logger.info(f"OAuth Service initialized with redirect URI: {self.google_redirect_uri}")
         logger.info(f"Frontend URL: {self.frontend_url}")
     
+    async def close(self) -> None:
+        """Close the shared HTTP client"""
+        await self._client.aclose()
+    
     def is_configured(self, provider: str) -> bool:
         """Check if OAuth provider is properly configured"""
         if provider == "google":
@@ -71,24 +98,9 @@ class OAuthService:
         return secrets.token_urlsafe(32)
     
     def store_oauth_state(self, state: str, provider: str) -> bool:
-        """Store OAuth state in database for verification"""
+        """Store OAuth state for verification on callback (expires after OAUTH_STATE_TTL_SECONDS)"""
         try:
-            expires_at = datetime.utcnow() + timedelta(minutes=10)  # 10 minute expiry
-            
-            state_data = {
-                "state": state,
-                "provider": provider,
-                "expires_at": expires_at.isoformat(),
-                "used": False,
-                "created_at": datetime.utcnow().isoformat()
-            }
-            
-            # Store in a simple table or cache - for now we'll use a simple in-memory store
-            # In production, you'd want to store this in Redis or database
-            if not hasattr(self, '_oauth_states'):
-                self._oauth_states = {}
-            
-            self._oauth_states[state] = state_data
+            self._oauth_states[state] = {"provider": provider}
             logger.info(f"Stored OAuth state: {state[:8]}...")
             return True
             
@@ -99,34 +111,18 @@ class OAuthService:
     def verify_oauth_state(self, state: str, provider: str) -> bool:
         """Verify OAuth state parameter"""
         try:
-            if not hasattr(self, '_oauth_states'):
-                logger.error(f"OAuth state storage not initialized")
-                return False
-                
-            if state not in self._oauth_states:
-                logger.error(f"OAuth state not found: {state[:8]}...")
-                # For debugging, log all available states
-                available_states = list(self._oauth_states.keys())
-                logger.error(f"Available states: {[s[:8] for s in available_states]}")
+            # States are single-use: popping consumes it and frees the entry in one step. Expired
+            # states have already been evicted, so missing covers unknown, expired and replayed
+            state_data = self._oauth_states.pop(state, None)
+            if state_data is None:
+                logger.error(f"OAuth state not found, expired or already used: {state[:8]}...")
                 return False
             
-            state_data = self._oauth_states[state]
-            
-            # Check if state matches provider and hasn't been used
+            # Check if state matches provider
             if state_data["provider"] != provider:
                 logger.error(f"OAuth state provider mismatch: expected {provider}, got {state_data['provider']}")
                 return False
-                
-            if state_data["used"]:
-                logger.error(f"OAuth state already used: {state[:8]}...")
-                return False
-                
-            if datetime.fromisoformat(state_data["expires_at"]) < datetime.utcnow():
-                logger.error(f"OAuth state expired: {state[:8]}...")
-                return False
             
-            # Mark as used
-            state_data["used"] = True
             logger.info(f"OAuth state verified: {state[:8]}...")
             return True
             
@@ -142,15 +138,7 @@ class OAuthService:
         state = self.generate_state()
         self.store_oauth_state(state, "google")
         
-        params = {
-            "client_id": self.google_client_id,
-            "redirect_uri": self.google_redirect_uri,
-            "scope": " ".join(self.google_scopes),
-            "response_type": "code",
-            "state": state,
-            "access_type": "offline",
-            "prompt": "consent"
-        }
+        params = {**self._google_auth_params, "state": state}
         
         auth_url = f"{self.google_auth_url}?{urlencode(params)}"
         logger.info(f"Generated Google OAuth URL with state: {state[:8]}...")
@@ -177,24 +165,27 @@ class OAuthService:
             
             logger.info(f"Exchanging code for tokens with redirect_uri: {self.google_redirect_uri}")
             
-            token_response = requests.post(self.google_token_url, data=token_data, timeout=30)
+            token_response = await self._client.post(self.google_token_url, data=token_data)
             
-            if not token_response.ok:
+            if not token_response.is_success:
                 logger.error(f"Token exchange failed: {token_response.status_code} - {token_response.text}")
                 raise Exception(f"Token exchange failed: {token_response.status_code}")
             
-            tokens = token_response.json()
+            tokens = orjson.loads(token_response.content)
             logger.info("Successfully exchanged code for tokens")
             
-            # Get user info
-            headers = {"Authorization": f"Bearer {tokens['access_token']}"}
-            user_response = requests.get(self.google_userinfo_url, headers=headers, timeout=30)
-            
-            if not user_response.ok:
-                logger.error(f"User info request failed: {user_response.status_code} - {user_response.text}")
-                raise Exception(f"User info request failed: {user_response.status_code}")
-            
-            user_info = user_response.json()
+            # The openid scope puts the profile in the ID token, which saves the userinfo round
+            # trip; the userinfo endpoint is only a fallback
+            user_info = self._google_id_token_profile(tokens.get("id_token"))
+            if user_info is None:
+                headers = {"Authorization": f"Bearer {tokens['access_token']}"}
+                user_response = await self._client.get(self.google_userinfo_url, headers=headers)
+                
+                if not user_response.is_success:
+                    logger.error(f"User info request failed: {user_response.status_code} - {user_response.text}")
+                    raise Exception(f"User info request failed: {user_response.status_code}")
+                
+                user_info = orjson.loads(user_response.content)
             logger.info(f"Retrieved user info for: {user_info.get('email', 'unknown')}")
             
             # Create or get user
@@ -210,8 +201,7 @@ class OAuthService:
             user = await self.create_or_get_oauth_user(user_data)
             
             # Generate JWT tokens
-            access_token = self.auth_service.create_access_token(user["id"])
-            refresh_token = self.auth_service.create_refresh_token(user["id"])
+            access_token, refresh_token = self.auth_service.create_token_pair(user["id"])
             
             logger.info(f"OAuth login successful for user: {user['email']}")
             
@@ -226,6 +216,42 @@ class OAuthService:
             logger.error(f"Google OAuth callback error: {str(e)}", exc_info=True)
             raise
     
+    def _google_id_token_profile(self, id_token: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Read the user profile from a Google ID token, shaped like a userinfo response.
+
+        The token comes straight from Google's token endpoint over TLS in exchange for our client
+        secret, so per OpenID Connect Core 3.1.3.7 its signature need not be re-verified; issuer,
+        audience and expiry are still checked. Returns None if the token is missing or unusable.
+        """
+        if not id_token:
+            return None
+        try:
+            payload = id_token.split(".")[1]
+            claims = orjson.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        except (IndexError, ValueError):
+            logger.warning("Could not decode Google ID token, falling back to userinfo")
+            return None
+        
+        if (
+            claims.get("iss") not in GOOGLE_ID_TOKEN_ISSUERS
+            or claims.get("aud") != self.google_client_id
+            or claims.get("exp", 0) < time.time()
+            or "email" not in claims
+        ):
+            logger.warning("Google ID token failed issuer/audience/expiry checks, falling back to userinfo")
+            return None
+        
+        profile = {
+            "id": claims["sub"],
+            "email": claims["email"],
+            "verified_email": claims.get("email_verified", False),
+            "name": claims.get("name"),
+            "given_name": claims.get("given_name"),
+            "picture": claims.get("picture")
+        }
+        # Like userinfo, leave out what the token doesn't carry (callers fall back with .get)
+        return {key: value for key, value in profile.items() if value is not None}
+    
     async def create_or_get_oauth_user(self, user_data: Dict[str, Any]) -> Dict[str, Any]:
         """Create or get user from OAuth data"""
         try:
@@ -234,6 +260,10 @@ class OAuthService:
             
             if existing_user:
                 logger.info(f"Found existing user: {user_data['email']}")
+                # Nothing OAuth can fill in is missing (the usual returning-user case)
+                if existing_user.get("email_verified") and existing_user.get("avatar_url"):
+                    return existing_user
+                
                 # Update user with OAuth info if needed
                 update_data = {}
                 if not existing_user.get("email_verified") and user_data.get("email_verified"):
@@ -261,19 +291,12 @@ class OAuthService:
                 "password": random_password,  # Will be hashed by auth service
                 "name": user_data["name"],
                 "age": age,
-                "avatar": user_data.get("avatar_url")
-            }
-            
-            # Create user through auth service
-            user = await self.auth_service.create_user_from_dict(new_user_data)
-            
-            # Update with OAuth-specific data
-            oauth_update = {
+                "avatar": user_data.get("avatar_url"),
                 "email_verified": user_data.get("email_verified", True)
             }
             
-            await self.auth_service.update_user(user["id"], oauth_update)
-            user.update(oauth_update)
+            # Create user through auth service; the OAuth fields go into the same insert
+            user = await self.auth_service.create_user_from_dict(new_user_data)
             
             logger.info(f"Successfully created OAuth user: {user['email']}")
             return user
@@ -3,135 +3,242 @@ Utility functions for SafeDoser backend
 """
 
 import os
+import atexit
+import hashlib
 import logging
+import logging.handlers
+import queue
 import base64
+import re
 import uuid
 from typing import Optional
-from datetime import datetime
+from datetime import datetime, time, timedelta
 import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 from fastapi import UploadFile, HTTPException
 from PIL import Image
 import io
 
+# pybase64 encodes with SIMD (libbase64) and can return str directly; stdlib is the fallback
+try:
+    import pybase64
+
+    def _b64encode_str(data: bytes) -> str:
+        return pybase64.b64encode_as_string(data)
+except ImportError:
+    def _b64encode_str(data: bytes) -> str:
+        return base64.b64encode(data).decode('ascii')
+
+# Started by setup_logging; owns the real (blocking) handlers
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
 def setup_logging():
     """Setup logging configuration"""
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.StreamHandler(),
-            logging.FileHandler('safedoser.log') if os.getenv('ENVIRONMENT') == 'production' else logging.NullHandler()
-        ]
-    )
-
-async def handle_image_upload(file: UploadFile, user_id: str) -> str:
-    """Handle image upload and return URL"""
+    global _log_listener
+    root = logging.getLogger()
+    if _log_listener is not None or root.handlers:
+        return
+    
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handlers = [logging.StreamHandler()]
+    if os.getenv('ENVIRONMENT') == 'production':
+        handlers.append(logging.FileHandler('safedoser.log'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    # Log calls from request handlers only enqueue the record; the console/file writes happen on
+    # the listener's thread instead of blocking the event loop
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+    
+    _log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
+# Supabase Storage bucket for uploaded images. When unset, uploads are returned inline as base64
+# data URLs (the legacy behaviour); the bucket must be public for the returned URL to load
+IMAGE_STORAGE_BUCKET = os.getenv("IMAGE_STORAGE_BUCKET")
+
+# Largest accepted upload (files above 5 MB are still downscaled); read in chunks of this size
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = 64 * 1024
+
+# Pillow decode/resize/encode is CPU-bound; it runs on its own pool (Pillow releases the GIL in
+# its codecs) so uploads neither block the event loop nor crowd out the default executor that
+# the database calls use
+_image_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="image")
+
+# Only the formats we accept as uploads are probed, and decompression bombs are refused earlier
+# than Pillow's ~89 MP default
+_UPLOAD_IMAGE_FORMATS = ('JPEG', 'PNG', 'GIF', 'WEBP')
+Image.MAX_IMAGE_PIXELS = 50_000_000
+
+def _verify_image(content: bytes) -> None:
+    """Raise if content is not a readable image"""
+    Image.open(io.BytesIO(content), formats=_UPLOAD_IMAGE_FORMATS).verify()
+
+def _resize_image(content: bytes, max_size: tuple, quality: int, resample: Image.Resampling) -> bytes:
+    """Shrink an image to fit max_size (keeping aspect ratio), in its original format; raises if
+    the image can't be decoded"""
+    image = Image.open(io.BytesIO(content), formats=_UPLOAD_IMAGE_FORMATS)
+    image.thumbnail(max_size, resample)
+    
+    output = io.BytesIO()
+    format = image.format or 'JPEG'
+    image.save(output, format=format, quality=quality)
+    return output.getvalue()
+
+async def handle_image_upload(file: UploadFile, user_id: str, supabase=None) -> str:
+    """Handle image upload and return URL (a public Storage URL, or a data URL without a bucket)"""
     try:
-        # Read file content
-        content = await file.read()
+        # Read file content in chunks so an oversized upload is rejected before it is all in memory
+        if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="Image file too large")
+        # The upload is hashed as it streams in; the digest names the stored object, so
+        # re-uploading the same image reuses it instead of storing another copy
+        chunks = []
+        received = 0
+        digest = hashlib.sha256()
+        while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+            received += len(chunk)
+            if received > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail="Image file too large")
+            digest.update(chunk)
+            chunks.append(chunk)
+        content = b"".join(chunks)
+        
+        loop = asyncio.get_running_loop()
         
-        # Validate image
         try:
-            image = Image.open(io.BytesIO(content))
-            image.verify()
+            if len(content) > 5 * 1024 * 1024:  # 5MB limit
+                # Resize image if too large. Decoding it validates it, so there is no separate
+                # verify() pass. Bilinear is enough here: thumbnail() lets JPEGs decode at a
+                # reduced scale first, and the result is re-encoded at quality 85 anyway
+                content = await loop.run_in_executor(_image_executor, _resize_image, content, (800, 800), 85, Image.Resampling.BILINEAR)
+            else:
+                # Validate image; verify() checks structure without decoding pixels, which is cheaper
+                # than a full decode for images that are kept as they are
+                await loop.run_in_executor(_image_executor, _verify_image, content)
         except Exception:
             raise HTTPException(status_code=400, detail="Invalid image file")
         
-        # Reset file pointer
-        await file.seek(0)
-        content = await file.read()
-        
-        # Resize image if too large
-        if len(content) > 5 * 1024 * 1024:  # 5MB limit
-            image = Image.open(io.BytesIO(content))
-            
-            # Calculate new size maintaining aspect ratio
-            max_size = (800, 800)
-            image.thumbnail(max_size, Image.Resampling.LANCZOS)
-            
-            # Save resized image
-            output = io.BytesIO()
-            format = image.format or 'JPEG'
-            image.save(output, format=format, quality=85)
-            content = output.getvalue()
-        
-        # In a real implementation, you would upload to cloud storage
-        # For now, we'll return a base64 data URL
-        base64_content = base64.b64encode(content).decode('utf-8')
         mime_type = file.content_type or 'image/jpeg'
         
+        if IMAGE_STORAGE_BUCKET and supabase is not None:
+            # Store the raw bytes and hand back a URL, so clients fetch (and cache) the image
+            # instead of carrying a third-larger base64 copy in every response
+            bucket = supabase.storage.from_(IMAGE_STORAGE_BUCKET)
+            ext = os.path.splitext(file.filename or '')[1]
+            path = f"{user_id}/{digest.hexdigest()}{ext}"
+            await asyncio.to_thread(bucket.upload, path, content, {"content-type": mime_type, "upsert": "true"})
+            return bucket.get_public_url(path)
+        
+        base64_content = _b64encode_str(content)
         return f"data:{mime_type};base64,{base64_content}"
         
     except HTTPException:
         raise
     except Exception as e:
-        logging.error(f"Image upload error: {str(e)}")
+        logging.error("Image upload error: %s", e)
         raise HTTPException(status_code=500, detail="Failed to upload image")
 
 def generate_unique_filename(original_filename: str) -> str:
     """Generate unique filename for uploads"""
+    # splitext (not a bare rfind('.')) so the extension can never carry a path separator
     ext = os.path.splitext(original_filename)[1]
-    unique_id = str(uuid.uuid4())
-    timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+    unique_id = uuid.uuid4().hex
+    now = datetime.utcnow()
+    timestamp = f"{now.year}{now.month:02d}{now.day:02d}_{now.hour:02d}{now.minute:02d}{now.second:02d}"
     return f"{timestamp}_{unique_id}{ext}"
 
+# Content types accepted as images
+ALLOWED_IMAGE_TYPES = frozenset({
+    'image/jpeg',
+    'image/jpg',
+    'image/png',
+    'image/gif',
+    'image/webp'
+})
+
 def validate_image_type(content_type: str) -> bool:
     """Validate if content type is a supported image format"""
-    allowed_types = [
-        'image/jpeg',
-        'image/jpg', 
-        'image/png',
-        'image/gif',
-        'image/webp'
-    ]
-    return content_type.lower() in allowed_types
+    # Content types almost always arrive lowercase; only lowercase when the direct lookup misses
+    return content_type in ALLOWED_IMAGE_TYPES or content_type.lower() in ALLOWED_IMAGE_TYPES
+
+# Runs of anything but ASCII letters, digits, dots and hyphens (underscores included), so one
+# substitution both replaces and collapses them
+_UNSAFE_FILENAME_RE = re.compile(r'[^a-zA-Z0-9.-]+')
 
 def sanitize_filename(filename: str) -> str:
     """Sanitize filename for safe storage"""
-    import re
-    # Remove any non-alphanumeric characters except dots and hyphens
-    sanitized = re.sub(r'[^a-zA-Z0-9.-]', '_', filename)
-    # Remove multiple consecutive underscores
-    sanitized = re.sub(r'_+', '_', sanitized)
-    # Remove leading/trailing underscores
-    sanitized = sanitized.strip('_')
-    return sanitized
-
-async def compress_image(image_data: bytes, max_size: tuple = (800, 800), quality: int = 85) -> bytes:
-    """Compress image to reduce file size"""
-    try:
-        image = Image.open(io.BytesIO(image_data))
-        
-        # Convert to RGB if necessary
-        if image.mode in ('RGBA', 'LA', 'P'):
+    # Replace each run of unsafe characters with a single underscore, then trim the ends
+    return _UNSAFE_FILENAME_RE.sub('_', filename).strip('_')
+
+# compress_image returns JPEGs up to this size untouched when they already fit max_size
+COMPRESS_SKIP_MAX_BYTES = 500 * 1024
+
+def _compress_image(image_data: bytes, max_size: tuple, quality: int, resample: Image.Resampling) -> bytes:
+    """Flatten to RGB, fit within max_size and re-encode as JPEG"""
+    # Image.open only parses the header, so this check costs no pixel decode
+    image = Image.open(io.BytesIO(image_data))
+    
+    # Already a small RGB JPEG within bounds: re-encoding would only cost CPU (and quality)
+    if (image.format == 'JPEG' and image.mode == 'RGB' and len(image_data) <= COMPRESS_SKIP_MAX_BYTES
+            and image.size[0] <= max_size[0] and image.size[1] <= max_size[1]):
+        return image_data
+    
+    # Convert to RGB if necessary. Palette images without a transparent index and fully opaque
+    # RGBA images convert directly; only real transparency needs compositing onto white
+    if image.mode == 'P' and 'transparency' not in image.info:
+        image = image.convert('RGB')
+    elif image.mode in ('RGBA', 'LA', 'P'):
+        if image.mode == 'P':
+            image = image.convert('RGBA')
+        if image.mode == 'RGBA' and image.getextrema()[3][0] == 255:
+            image = image.convert('RGB')
+        else:
             background = Image.new('RGB', image.size, (255, 255, 255))
-            if image.mode == 'P':
-                image = image.convert('RGBA')
             background.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
             image = background
-        
-        # Resize if larger than max_size
-        if image.size[0] > max_size[0] or image.size[1] > max_size[1]:
-            image.thumbnail(max_size, Image.Resampling.LANCZOS)
-        
-        # Save compressed image
-        output = io.BytesIO()
-        image.save(output, format='JPEG', quality=quality, optimize=True)
-        
-        return output.getvalue()
+    
+    # Resize if larger than max_size
+    if image.size[0] > max_size[0] or image.size[1] > max_size[1]:
+        image.thumbnail(max_size, resample)
+    
+    # Save compressed image
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=quality)
+    
+    return output.getvalue()
+
+async def compress_image(image_data: bytes, max_size: tuple = (800, 800), quality: int = 85,
+                         resample: Image.Resampling = Image.Resampling.BILINEAR) -> bytes:
+    """Compress image to reduce file size (pass Image.Resampling.LANCZOS for the sharper, slower filter)"""
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_image_executor, _compress_image, image_data, max_size, quality, resample)
         
     except Exception as e:
-        logging.error(f"Image compression error: {str(e)}")
+        logging.error("Image compression error: %s", e)
         return image_data  # Return original if compression fails
 
+def _parse_hhmm(time_str: str) -> time:
+    """Parse a 24-hour HH:MM string (the format the models enforce) without strptime"""
+    if len(time_str) != 5 or time_str[2] != ':' or not (time_str[:2].isdigit() and time_str[3:].isdigit()):
+        raise ValueError(f"Invalid time: {time_str!r}")
+    # time() range-checks the hour and minute
+    return time(int(time_str[:2]), int(time_str[3:]))
+
 def format_supplement_time(time_str: str) -> str:
     """Format supplement time for display"""
     try:
-        from datetime import datetime
-        time_obj = datetime.strptime(time_str, '%H:%M')
-        return time_obj.strftime('%I:%M %p')
-    except:
+        time_obj = _parse_hhmm(time_str)
+        hour = time_obj.hour
+        return f"{hour % 12 or 12:02d}:{time_obj.minute:02d} {'AM' if hour < 12 else 'PM'}"
+    except (ValueError, TypeError):
         return time_str
 
 def parse_times_of_day(times_data: dict) -> dict:
@@ -148,7 +255,7 @@ def parse_times_of_day(times_data: dict) -> dict:
                 if isinstance(time_str, str):
                     try:
                         # Validate time format
-                        datetime.strptime(time_str, '%H:%M')
+                        _parse_hhmm(time_str)
                         parsed[period].append(time_str)
                     except ValueError:
                         continue
@@ -161,22 +268,24 @@ def calculate_next_dose_time(supplement_data: dict) -> Optional[datetime]:
         times_of_day = supplement_data.get('times_of_day', {})
         current_time = datetime.now()
         
-        all_times = []
+        # Running minimum; no list of candidates is built
+        best = None
         for period, times in times_of_day.items():
             for time_str in times:
                 try:
-                    time_obj = datetime.strptime(time_str, '%H:%M').time()
+                    time_obj = _parse_hhmm(time_str)
                     next_dose = datetime.combine(current_time.date(), time_obj)
                     
                     # If time has passed today, schedule for tomorrow
                     if next_dose <= current_time:
-                        next_dose = next_dose.replace(day=next_dose.day + 1)
+                        next_dose += timedelta(days=1)
                     
-                    all_times.append(next_dose)
+                    if best is None or next_dose < best:
+                        best = next_dose
                 except ValueError:
                     continue
         
-        return min(all_times) if all_times else None
+        return best
         
     except Exception:
         return None
@@ -189,20 +298,23 @@ def get_supplement_status(supplement_data: dict, current_time: datetime = None)
     try:
         times_of_day = supplement_data.get('times_of_day', {})
         
+        # Compare seconds since midnight directly instead of building a datetime per slot
+        now_seconds = (current_time.hour * 3600 + current_time.minute * 60 + current_time.second
+                       + current_time.microsecond / 1_000_000)
+        
         for period, times in times_of_day.items():
             for time_str in times:
                 try:
-                    time_obj = datetime.strptime(time_str, '%H:%M').time()
-                    dose_time = datetime.combine(current_time.date(), time_obj)
+                    time_obj = _parse_hhmm(time_str)
                     
                     # Check if dose is due (within 30 minutes)
-                    time_diff = (dose_time - current_time).total_seconds() / 60
+                    time_diff = time_obj.hour * 3600 + time_obj.minute * 60 - now_seconds
                     
-                    if -30 <= time_diff <= 30:
+                    if -1800 <= time_diff <= 1800:
                         return 'due'
-                    elif time_diff < -30:
+                    elif time_diff < -1800:
                         return 'missed'
-                    elif time_diff > 30:
+                    elif time_diff > 1800:
                         return 'upcoming'
                         
                 except ValueError:
@@ -215,6 +327,7 @@ def get_supplement_status(supplement_data: dict, current_time: datetime = None)
 
 class AsyncTimer:
     """Async timer utility for scheduling tasks"""
+    __slots__ = ("tasks",)
     
     def __init__(self):
         self.tasks = {}
@@ -224,14 +337,21 @@ class AsyncTimer:
         async def run_task():
             await asyncio.sleep(delay)
             await callback(*args, **kwargs)
-            self.tasks.pop(task_id, None)
         
         # Cancel existing task if any
         if task_id in self.tasks:
             self.tasks[task_id].cancel()
         
-        # Schedule new task
-        self.tasks[task_id] = asyncio.create_task(run_task())
+        # Schedule new task; the done callback drops it however it finishes (including when the
+        # callback raises or the task is cancelled)
+        task = asyncio.create_task(run_task())
+        task.add_done_callback(functools.partial(self._forget_task, task_id))
+        self.tasks[task_id] = task
+    
+    def _forget_task(self, task_id: str, task: asyncio.Task):
+        """Remove a finished task, unless task_id has since been rescheduled to a newer one"""
+        if self.tasks.get(task_id) is task:
+            del self.tasks[task_id]
     
     def cancel_task(self, task_id: str):
         """Cancel a scheduled task"""